@@ -0,0 +1,230 @@
+'''Content-hashed URLs for the birmingham extension's static files.'''
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The URL path that the fingerprinted files are served under, by
+# middleware.AssetMiddleware.
+PREFIX = '/birmingham-assets'
+
+PUBLIC_DIRECTORY = os.path.join(os.path.dirname(__file__), 'public')
+FANSTATIC_DIRECTORY = os.path.join(os.path.dirname(__file__), 'fanstatic')
+
+# The name that update_config() registers the fanstatic directory as.
+FANSTATIC_LIBRARY = 'ckanext-birmingham'
+
+# The kinds of file that compress well, and so get precompressed siblings.
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.ico', '.html', '.txt',
+                           '.json', '.xml')
+
+# The precompressed siblings' encodings and file extensions, most preferred
+# first.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def build_manifest():
+    '''Return the content hashes of the extension's static files.
+
+    Files in the public directory are named by their URL path, e.g.
+    ``/favicon.ico``, and files in the fanstatic directory by their resource
+    name, e.g. ``ckanext-birmingham/styles/birmingham.css``.
+
+    :returns: a dict mapping names to (local path, hash) pairs
+    :rtype: dict
+
+    '''
+    manifest = {}
+    for directory, prefix in ((PUBLIC_DIRECTORY, '/'),
+                              (FANSTATIC_DIRECTORY, FANSTATIC_LIBRARY + '/')):
+        for root, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if (filename.startswith('.') or
+                        filename.endswith(tuple(
+                            extension for _, extension in ENCODINGS))):
+                    continue
+                path = os.path.join(root, filename)
+                name = prefix + os.path.relpath(path, directory).replace(
+                    os.sep, '/')
+                manifest[name] = (path, _file_hash(path))
+    return manifest
+
+
+def load_manifest():
+    '''(Re)build the manifest that asset_url() and AssetMiddleware use.'''
+    global _manifest
+    manifest = build_manifest()
+    with _manifest_lock:
+        _manifest = manifest
+    return manifest
+
+
+def manifest():
+    '''Return the manifest, building it the first time it's asked for.'''
+    if _manifest is None:
+        return load_manifest()
+    return _manifest
+
+
+def manifest_digest():
+    '''Return a hash of the whole manifest.
+
+    It changes whenever any of the extension's static files does, e.g. after
+    a deploy.
+
+    '''
+    sha1 = hashlib.sha1()
+    for name, (_, digest) in sorted(manifest().items()):
+        sha1.update('{0}={1}\n'.format(name, digest).encode('utf-8'))
+    return sha1.hexdigest()[:12]
+
+
+def asset_url(name):
+    '''Return the fingerprinted URL of one of the extension's static files.
+
+    The URL changes whenever the file's content does, so it's served with
+    far-future cache headers. Names that aren't in the manifest, including
+    remote URLs, are returned unchanged.
+
+    :param name: the file's URL path (``/favicon.ico``) or fanstatic resource
+                 name (``ckanext-birmingham/styles/birmingham.css``)
+
+    '''
+    entry = manifest().get(name)
+    if entry is None:
+        return name
+    return '{0}/{1}/{2}'.format(PREFIX, entry[1], name.lstrip('/'))
+
+
+def lookup(url_path):
+    '''Return the file that a fingerprinted URL is for.
+
+    :returns: the name, local path and current hash of the file, and the
+              hash that the URL was built with, or None if the URL isn't for
+              one of the extension's files
+
+    '''
+    if not url_path.startswith(PREFIX + '/'):
+        return None
+    parts = url_path[len(PREFIX) + 1:].split('/', 1)
+    if len(parts) != 2:
+        return None
+    digest, name = parts
+    current = manifest()
+    for candidate in ('/' + name, name):
+        if candidate in current:
+            path, current_digest = current[candidate]
+            return candidate, path, current_digest, digest
+    return None
+
+
+def compress_static_files():
+    '''Write precompressed siblings of the extension's compressible files.
+
+    Each compressible file in the public and fanstatic directories gets a
+    ``.gz`` sibling and, if the brotli package is installed, a ``.br`` one.
+    Siblings that wouldn't be smaller than the file aren't kept.
+
+    :returns: the paths of the siblings that were written
+    :rtype: list of strings
+
+    '''
+    written = []
+    for path, _ in manifest().values():
+        if not path.endswith(COMPRESSIBLE_EXTENSIONS):
+            continue
+        with open(path, 'rb') as file_:
+            data = file_.read()
+        for encoding, extension in ENCODINGS:
+            if encoding == 'br' and brotli is None:
+                continue
+            compressed = _compress(data, encoding)
+            sibling = path + extension
+            if len(compressed) >= len(data):
+                if os.path.exists(sibling):
+                    os.remove(sibling)
+                continue
+            _write(sibling, compressed)
+            written.append(sibling)
+    return written
+
+
+def precompressed(path, accept_encoding):
+    '''Return the best precompressed sibling of a file for a request.
+
+    :param accept_encoding: the request's Accept-Encoding header
+    :returns: the (encoding, sibling path) to serve, or None to serve the
+              file itself
+
+    '''
+    accepted = _accepted_encodings(accept_encoding or '')
+    for encoding, extension in ENCODINGS:
+        if encoding not in accepted:
+            continue
+        sibling = path + extension
+        try:
+            # Ignore siblings left over from an older version of the file.
+            if os.path.getmtime(sibling) >= os.path.getmtime(path):
+                return encoding, sibling
+        except OSError:
+            continue
+    return None
+
+
+def _accepted_encodings(accept_encoding):
+    accepted = set()
+    for item in accept_encoding.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        encoding, quality = parts[0].lower(), 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    return accepted
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data)
+    buf = io.BytesIO()
+    # mtime=0 so that the same file always compresses to the same bytes.
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                       compresslevel=9, mtime=0) as file_:
+        file_.write(data)
+    return buf.getvalue()
+
+
+def _write(path, data):
+    # Write to a temporary file and rename it into place, so the middleware
+    # never serves a half-written sibling.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file_:
+            file_.write(data)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()[:12]
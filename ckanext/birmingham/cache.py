@@ -0,0 +1,510 @@
+'''Caching used by the birmingham plugins' template helpers.'''
+import collections
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import pylons
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__name__)
+
+
+def request_store(name):
+    '''Return a dict that lives for the duration of the current request.
+
+    The dict is kept in the WSGI environ, so it is thrown away when the request
+    ends. Outside of a request (e.g. when called from a test or a paster
+    command) a new, empty dict is returned each time, so nothing is cached.
+
+    '''
+    try:
+        environ = pylons.request.environ
+    except TypeError:
+        # No request is registered for this thread.
+        return {}
+    return environ.setdefault('ckanext.birmingham.' + name, {})
+
+
+def memoize(name, func):
+    '''Wrap a template helper so it's evaluated at most once per request for
+    each set of arguments.
+
+    Calls with unhashable arguments (e.g. a list of packages) are passed
+    straight through to the helper.
+
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+
+        memo = request_store('memo')
+        stats = request_store('memo_stats')
+        if key in memo:
+            stats['hits'] = stats.get('hits', 0) + 1
+            return memo[key]
+        stats['misses'] = stats.get('misses', 0) + 1
+        result = memo[key] = func(*args, **kwargs)
+        return result
+    return wrapper
+
+
+def memoize_helpers(helpers):
+    '''Return a copy of a get_helpers() dict with every helper memoized.'''
+    return dict((name, memoize(name, func))
+                for name, func in helpers.items())
+
+
+def memo_stats():
+    '''Return the memoized helpers' hits and misses for the current request.
+
+    Each hit is a helper call that didn't have to be evaluated again.
+
+    '''
+    stats = request_store('memo_stats')
+    return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0)}
+
+
+class MemoryBackend(object):
+    '''A cache backend that keeps entries in this process's memory.
+
+    When a namespace is full, its least recently used entry is evicted.
+
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._namespaces = {}
+        self._generations = collections.defaultdict(int)
+
+    def get(self, namespace, key):
+        with self._lock:
+            data = self._namespaces.get(namespace)
+            if data is None or key not in data:
+                return None
+            # Re-insert the entry to mark it as the most recently used one.
+            entry = data[key] = data.pop(key)
+            return entry
+
+    def set(self, namespace, key, entry, maxsize, timeout):
+        with self._lock:
+            data = self._namespaces.setdefault(namespace,
+                                               collections.OrderedDict())
+            data.pop(key, None)
+            data[key] = entry
+            while len(data) > maxsize:
+                data.popitem(last=False)
+
+    def clear(self, namespace):
+        with self._lock:
+            self._namespaces.pop(namespace, None)
+            self._generations[namespace] += 1
+
+    def generation(self, namespace):
+        return self._generations[namespace]
+
+
+class FileBackend(object):
+    '''A cache backend that keeps entries in files in a directory.
+
+    All the processes on a host that use the same directory share the
+    entries. Each entry is a pickle file, written to a temporary file first
+    and then renamed into place so readers never see half-written entries.
+    When a namespace has more than maxsize entries the oldest are deleted.
+
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        _makedirs(directory)
+
+    def get(self, namespace, key):
+        try:
+            with open(self._path(namespace, key), 'rb') as file_:
+                deadline, entry = pickle.load(file_)
+        except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
+            return None
+        if deadline <= time.time():
+            return None
+        return entry
+
+    def set(self, namespace, key, entry, maxsize, timeout):
+        path = self._path(namespace, key)
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        self._write(path, (time.time() + timeout, entry))
+        self._prune(directory, maxsize)
+
+    def clear(self, namespace):
+        old_directory = self._generation_directory(namespace)
+        self._write(self._generation_path(namespace),
+                    self.generation(namespace) + 1)
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+    def generation(self, namespace):
+        try:
+            with open(self._generation_path(namespace), 'rb') as file_:
+                return pickle.load(file_)
+        except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
+            return 0
+
+    def _path(self, namespace, key):
+        return os.path.join(self._generation_directory(namespace),
+                            _key_digest(key))
+
+    def _generation_directory(self, namespace):
+        return os.path.join(self.directory, namespace,
+                            str(self.generation(namespace)))
+
+    def _generation_path(self, namespace):
+        return os.path.join(self.directory, namespace + '.generation')
+
+    def _write(self, path, obj):
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file_:
+                pickle.dump(obj, file_, 2)
+            os.rename(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _prune(self, directory, maxsize):
+        try:
+            names = [name for name in os.listdir(directory)
+                     if not name.startswith('.tmp')]
+            if len(names) <= maxsize:
+                return
+            paths = [os.path.join(directory, name) for name in names]
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - maxsize]:
+                os.remove(path)
+        except OSError:
+            # Another process pruned or cleared the namespace first.
+            pass
+
+
+class RedisBackend(object):
+    '''A cache backend that keeps entries in Redis.
+
+    All the processes that use the same Redis server share the entries. Works
+    with any client that has Redis's get(), set(..., ex=...) and incr()
+    methods. Redis expires the entries and, when it's configured with a
+    maxmemory policy, evicts them, so maxsize isn't used.
+
+    '''
+    def __init__(self, client, prefix='ckanext-birmingham'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        if redis is None:
+            raise ImportError('The redis cache backend needs the redis '
+                              'package to be installed')
+        return cls(redis.StrictRedis.from_url(url))
+
+    def get(self, namespace, key):
+        data = self.client.get(self._key(namespace, key))
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+    def set(self, namespace, key, entry, maxsize, timeout):
+        self.client.set(self._key(namespace, key), pickle.dumps(entry, 2),
+                        ex=max(int(timeout), 1))
+
+    def clear(self, namespace):
+        self.client.incr(self._generation_key(namespace))
+
+    def generation(self, namespace):
+        return int(self.client.get(self._generation_key(namespace)) or 0)
+
+    def _key(self, namespace, key):
+        return '{0}:{1}:{2}:{3}'.format(self.prefix, namespace,
+                                        self.generation(namespace),
+                                        _key_digest(key))
+
+    def _generation_key(self, namespace):
+        return '{0}:{1}:generation'.format(self.prefix, namespace)
+
+
+def backend_from_url(url):
+    '''Return the cache backend for a ckanext.birmingham.cache_backend URL.
+
+    ``memory`` for a MemoryBackend, ``file:///path/to/directory`` for a
+    FileBackend, or ``redis://host:port/db`` for a RedisBackend.
+
+    '''
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('file://'):
+        return FileBackend(url[len('file://'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend.from_url(url)
+    raise ValueError('Unknown cache backend: {0!r}'.format(url))
+
+
+def _key_digest(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+class TTLCache(object):
+    '''A size-bounded cache whose entries expire after a while.
+
+    The entries are kept in a cache backend, by default in this process's
+    memory, where they're shared by all the requests handled by the process.
+    With a FileBackend or RedisBackend they're shared by several processes.
+    Entries expire ttl seconds after they were set and, when the cache is
+    full, the least recently used entry is evicted.
+
+    Entries can be set with the loader that computes them, so that a
+    Refresher can recompute them in the background. While a Refresher's
+    thread is looking after the cache in this process,
+    stale_while_revalidate is True and expired entries are still returned
+    until they've been refreshed, but never once they're more than another
+    ttl seconds out of date.
+
+    '''
+    def __init__(self, maxsize=128, ttl=300, name='default', backend=None):
+        self.name = name
+        self.backend = backend or MemoryBackend()
+        self._lock = threading.Lock()
+        # The loaders of the entries set by this process, for the Refresher.
+        self._loaders = collections.OrderedDict()
+        # The Refresher that looks after the cache, if any.
+        self.refresher = None
+        # How often cached() found a value in the cache, or had to compute it.
+        self.hits = self.misses = 0
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize, ttl, backend=None):
+        '''Change the cache's size, ttl and (optionally) backend, and empty
+        it.
+
+        A maxsize or ttl of 0 turns the cache off.
+
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        if backend is not None:
+            self.backend = backend
+        self.clear()
+
+    @property
+    def stale_while_revalidate(self):
+        '''True if expired entries are returned until they're refreshed.'''
+        return self.refresher is not None and self.refresher.is_running()
+
+    def get(self, key, default=None):
+        entry = self.backend.get(self.name, key)
+        if entry is None:
+            return default
+        expires, value = entry
+        now = time.time()
+        if expires <= now and (now - expires >= self.ttl or
+                               not self.stale_while_revalidate):
+            return default
+        return value
+
+    def set(self, key, value, loader=None, generation=None):
+        '''Set key to value.
+
+        :param loader: a function that returns a fresh value for the key
+                       (optional)
+        :param generation: only set the value if the cache hasn't been cleared
+                           since generation() returned this (optional)
+
+        '''
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        if generation is not None and generation != self.generation():
+            return
+        # Keep stale entries around for a while, for stale_while_revalidate.
+        self.backend.set(self.name, key, (time.time() + self.ttl, value),
+                         maxsize=self.maxsize, timeout=2 * self.ttl)
+        if loader is not None:
+            with self._lock:
+                self._loaders.pop(key, None)
+                self._loaders[key] = loader
+                while len(self._loaders) > self.maxsize:
+                    self._loaders.popitem(last=False)
+
+    def generation(self):
+        '''Return a number that changes whenever the cache is cleared.'''
+        return self.backend.generation(self.name)
+
+    def due(self, within):
+        '''Return the (key, loader) of the entries set by this process that
+        expire within the given number of seconds, or that are gone.
+
+        '''
+        deadline = time.time() + within
+        with self._lock:
+            loaders = list(self._loaders.items())
+        due = []
+        for key, loader in loaders:
+            entry = self.backend.get(self.name, key)
+            if entry is None or entry[0] <= deadline:
+                due.append((key, loader))
+        return due
+
+    def clear(self):
+        with self._lock:
+            self._loaders.clear()
+        self.backend.clear(self.name)
+
+
+_MISSING = object()
+
+
+def cached(ttl_cache, key, func, *args, **kwargs):
+    '''Return func(*args, **kwargs), from ttl_cache if it's in there.'''
+    value = ttl_cache.get(key, _MISSING)
+    if value is not _MISSING:
+        ttl_cache.hits += 1
+    else:
+        ttl_cache.misses += 1
+        generation = ttl_cache.generation()
+        value = func(*args, **kwargs)
+        ttl_cache.set(key, value, functools.partial(func, *args, **kwargs),
+                      generation=generation)
+    return value
+
+
+class Refresher(object):
+    '''Refreshes the entries of some TTLCaches on a background thread.
+
+    Entries are recomputed with their loaders shortly before they expire, and
+    the caches serve their previous values until then, so requests don't have
+    to wait for them to be rebuilt. The warm functions are called once when
+    the thread starts.
+
+    Threads don't survive a fork, so if the Refresher was started before the
+    process forked (e.g. by a pre-forking server that loads CKAN in its
+    master process), the caches stop serving stale entries in the child and
+    the thread is started again there the next time is_running() is asked.
+
+    '''
+    def __init__(self, caches, warm=(), cleanup=None):
+        '''
+        :param caches: the TTLCaches to keep fresh
+        :param warm: functions to call when the thread starts
+        :param cleanup: a function to call after each round of refreshes,
+                        e.g. to release the thread's database session
+
+        '''
+        self.caches = caches
+        self.warm = warm
+        self.cleanup = cleanup
+        self.interval = 60
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        # The process that the thread was started in.
+        self._pid = None
+
+    def start(self, interval):
+        '''Start the background thread, refreshing every interval seconds.
+
+        Does nothing if it's already running.
+
+        '''
+        self.interval = interval
+        with self._start_lock:
+            if self._alive():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='birmingham-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+            for ttl_cache in self.caches:
+                ttl_cache.refresher = self
+
+    def stop(self, timeout=10):
+        '''Stop the background thread and wait for it to finish.'''
+        self._stop.set()
+        if self._alive():
+            self._thread.join(timeout)
+        self._thread = self._pid = None
+        for ttl_cache in self.caches:
+            ttl_cache.refresher = None
+
+    def is_running(self):
+        '''Return True if the thread is running in this process.
+
+        If it was started in the process that this one was forked from, it's
+        started again first.
+
+        '''
+        if self._thread is None:
+            return False
+        if self._pid != os.getpid() and not self._stop.is_set():
+            self.start(self.interval)
+        return self._alive()
+
+    def _alive(self):
+        return (self._thread is not None and self._pid == os.getpid() and
+                self._thread.is_alive())
+
+    def _run(self):
+        self._call(self.warm)
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def refresh(self):
+        '''Refresh the entries that would expire before the next round.'''
+        for ttl_cache in self.caches:
+            for key, loader in ttl_cache.due(within=self.interval * 2):
+                if self._stop.is_set():
+                    return
+                generation = ttl_cache.generation()
+                try:
+                    value = loader()
+                except Exception:
+                    log.exception('Refreshing %r failed, keeping the stale '
+                                  'value', key)
+                    continue
+                finally:
+                    self._cleanup()
+                ttl_cache.set(key, value, loader, generation=generation)
+
+    def _call(self, functions):
+        for function in functions:
+            try:
+                function()
+            except Exception:
+                log.exception('Warming %r failed', function)
+            finally:
+                self._cleanup()
+
+    def _cleanup(self):
+        if self.cleanup is not None:
+            self.cleanup()
@@ -0,0 +1,70 @@
+'''Paster commands for the birmingham plugins.'''
+import ckan.lib.cli as cli
+
+
+class BirminghamCommand(cli.CkanCommand):
+    '''Maintenance commands for the birmingham plugins.
+
+    Usage:
+
+      paster --plugin=ckanext-birmingham birmingham reconcile-editors -c <ini>
+        - Rebuild the up_to_n_editors plugin's count of editors from the
+          site's memberships and sysadmins. The count is kept up to date as
+          they change, run this periodically (e.g. from cron) to correct any
+          drift.
+
+      paster --plugin=ckanext-birmingham birmingham featured-images -c <ini>
+        - Write the resized variants of the featured image into the
+          extension's public directory. They're also written when CKAN
+          starts, run this at deploy time so the first start doesn't have to.
+
+      paster --plugin=ckanext-birmingham birmingham compress-assets -c <ini>
+        - Write gzip (and, if the brotli package is installed, brotli)
+          compressed copies of the extension's CSS, JavaScript and other
+          compressible static files, for the birmingham plugin to serve to
+          browsers that accept them. Run this at deploy time.
+
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'reconcile-editors':
+            self.reconcile_editors()
+        elif cmd == 'featured-images':
+            self.featured_images()
+        elif cmd == 'compress-assets':
+            self.compress_assets()
+        else:
+            print('Command {0} not recognized'.format(cmd))
+            print(self.usage)
+
+    def reconcile_editors(self):
+        import ckanext.birmingham.db as db
+        import ckanext.birmingham.plugin as plugin
+        db.setup()
+        count = plugin.reconcile_editor_count()
+        print('The site has {0} editors'.format(count))
+
+    def featured_images(self):
+        import pylons.config as config
+        import ckanext.birmingham.customizable_featured_image as featured
+        from ckanext.birmingham.settings import settings
+        settings.reload(config)
+        sources = featured.build_featured_image_derivatives(config)
+        if not sources:
+            print('The featured image {0} was not resized, it must be a file '
+                  'in a public directory and PIL must be installed'.format(
+                      settings.featured_image))
+        for source in sources:
+            print('{0}: {1}'.format(source['type'], source['srcset']))
+
+    def compress_assets(self):
+        import ckanext.birmingham.assets as assets
+        for path in assets.compress_static_files():
+            print('Wrote {0}'.format(path))
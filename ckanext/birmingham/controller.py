@@ -0,0 +1,23 @@
+'''Controllers added by the birmingham plugin.'''
+import pylons
+
+import ckan.lib.base as base
+
+import ckanext.birmingham.metrics as metrics
+import ckanext.birmingham.plugin as plugin
+from ckanext.birmingham.settings import settings
+
+
+class MetricsController(base.BaseController):
+
+    def metrics(self):
+        '''Return the plugins' metrics in the Prometheus text format.
+
+        Only available when ckanext.birmingham.metrics is on.
+
+        '''
+        if not settings.metrics:
+            base.abort(404)
+        pylons.response.headers['Content-Type'] = (
+            'text/plain; version=0.0.4; charset=utf-8')
+        return metrics.prometheus_text(plugin.metrics_caches())
@@ -1,22 +1,61 @@
-import pylons.config as config
+import logging
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
+import ckanext.birmingham.cache as cache
+import ckanext.birmingham.images as images
+import ckanext.birmingham.metrics as metrics
+from ckanext.birmingham.settings import settings
+
+log = logging.getLogger(__name__)
+
+# The <source>s of the featured image's resized variants, set when the plugin
+# is configured.
+_featured_image_sources = []
+
 
 def featured_caption():
-    return config.get(
-        "ckanext.birmingham.featured_caption", "This is a featured section")
+    return settings.featured_caption
 
 
 def featured_image():
-    return config.get(
-        "ckanext.birmingham.featured_image", "http://placehold.it/420x220")
+    return settings.featured_image
 
 
 def featured_alt_text():
-    return config.get(
-        "ckanext.birmingham.featured_alt_text", "Placeholder")
+    return settings.featured_alt_text
+
+
+def featured_image_sources():
+    """Return the type and srcset of each format of the featured image.
+
+    For <source> elements in a <picture>, most preferred format first. Empty
+    if the featured image couldn't be resized, e.g. because it's a remote URL
+    or because PIL isn't installed.
+
+    """
+    return _featured_image_sources
+
+
+def build_featured_image_derivatives(config):
+    """Write the resized variants of the featured image, if it's local.
+
+    :returns: the variants' sources, see featured_image_sources()
+
+    """
+    global _featured_image_sources
+    source = images.find_public_file(settings.featured_image, config)
+    if source is None:
+        _featured_image_sources = []
+        return _featured_image_sources
+    try:
+        _featured_image_sources = images.build_derivatives(source)
+    except (IOError, OSError) as e:
+        log.warning("Couldn't resize the featured image {0}: {1}".format(
+            source, e))
+        _featured_image_sources = []
+    return _featured_image_sources
 
 
 class CustomizableFeaturedImagePlugin(plugins.SingletonPlugin):
@@ -24,14 +63,21 @@ class CustomizableFeaturedImagePlugin(plugins.SingletonPlugin):
 
     """
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.ITemplateHelpers)
 
     def update_config(self, config):
         toolkit.add_template_directory(config, "templates")
+        toolkit.add_public_directory(config, "public")
+
+    def configure(self, config):
+        settings.reload(config)
+        build_featured_image_derivatives(config)
 
     def get_helpers(self):
-        return {
+        return metrics.instrument_all("helper", cache.memoize_helpers({
             "birmingham_featured_caption": featured_caption,
             "birmingham_featured_image": featured_image,
             "birmingham_featured_alt_text": featured_alt_text,
-        }
+            "birmingham_featured_image_sources": featured_image_sources,
+        }))
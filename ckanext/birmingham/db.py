@@ -0,0 +1,280 @@
+'''Database tables used by the birmingham plugins.'''
+import contextlib
+import datetime
+import json
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+
+import ckan.model as model
+
+import ckanext.birmingham.metrics as metrics
+from ckanext.birmingham.settings import settings
+
+
+package_formats_table = sa.Table(
+    'birmingham_package_formats', model.meta.metadata,
+    sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+    # A JSON list of the package's distinct resource formats.
+    sa.Column('formats', sa.types.UnicodeText, nullable=False),
+)
+
+counters_table = sa.Table(
+    'birmingham_counters', model.meta.metadata,
+    sa.Column('name', sa.types.UnicodeText, primary_key=True),
+    sa.Column('value', sa.types.Integer, nullable=False),
+    sa.Column('modified', sa.types.DateTime, nullable=False,
+              default=datetime.datetime.utcnow),
+)
+
+
+def setup():
+    '''Create the birmingham tables if they don't exist yet.'''
+    for table in (package_formats_table, counters_table):
+        table.create(bind=model.meta.engine, checkfirst=True)
+
+
+# The engine and session factory of the read replica, if
+# ckanext.birmingham.read_replica_url is set.
+_read_engine = None
+_read_sessionmaker = None
+
+
+def setup_read_replica(url):
+    '''Send read_session()'s queries to the database at the given URL.
+
+    The replica gets a pooled engine of its own. Does nothing if the replica
+    is already set up for this URL.
+
+    :param url: a SQLAlchemy database URL, or '' to send read_session()'s
+                queries to the primary database again
+
+    '''
+    global _read_engine, _read_sessionmaker
+    if _read_engine is not None:
+        if str(_read_engine.url) == url:
+            return
+        _read_engine.dispose()
+        _read_engine = _read_sessionmaker = None
+    if url:
+        _read_engine = sa.create_engine(url, pool_recycle=3600)
+        if settings.metrics:
+            # The helpers that read from the replica report its queries.
+            metrics.listen_for_queries(_read_engine)
+        _read_sessionmaker = sa.orm.sessionmaker(bind=_read_engine,
+                                                 autoflush=False)
+
+
+@contextlib.contextmanager
+def read_session():
+    '''Return a session for read-only queries that may lag behind a little.
+
+    This is a session on the read replica if one is set up, or
+    ckan.model.Session if not. A replica session is closed, and its
+    connection returned to the pool, at the end of the with block, so it
+    never holds a transaction open between requests.
+
+    Don't use it for anything that needs to see the current request's
+    changes, or that decides whether a change is allowed.
+
+    '''
+    if _read_sessionmaker is None:
+        yield model.Session
+        return
+    session = _read_sessionmaker()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def distinct_formats(formats):
+    '''Return the distinct, non-empty formats from the given formats.
+
+    The formats are returned in the order they were first seen, the same as
+    what h.dict_list_reduce(resources, 'format') would return.
+
+    '''
+    result = []
+    for format_ in formats:
+        if format_ and format_ not in result:
+            result.append(format_)
+    return result
+
+
+def save_package_formats(package_id, formats, session=None):
+    '''Save the resource formats summary of the given package.
+
+    :param formats: the package's distinct resource formats
+    :type formats: list of strings
+    :param session: the session of the package's own transaction, to write
+                    the summary in that transaction so it's committed or
+                    rolled back with the package (optional, default: write
+                    and commit it in a transaction of its own, e.g. when the
+                    search index is rebuilt outside of any transaction)
+
+    '''
+    if session is None:
+        with model.meta.engine.begin() as connection:
+            _write_package_formats(connection, package_id, formats)
+    else:
+        _write_package_formats(session, package_id, formats)
+        _pending_package_ids(session).add(package_id)
+
+
+def delete_package_formats(package_id, session=None):
+    '''Delete the resource formats summary of the given package.
+
+    :param session: the session of the package's own transaction (optional,
+                    default: delete it in a transaction of its own)
+
+    '''
+    if session is None:
+        with model.meta.engine.begin() as connection:
+            _write_package_formats(connection, package_id, None)
+    else:
+        _write_package_formats(session, package_id, None)
+        _pending_package_ids(session).add(package_id)
+
+
+def package_formats_pending(session, package_id):
+    '''Return True if the given session has saved or deleted the package's
+    summary in its current, uncommitted transaction.
+
+    The search index is updated while the package's transaction is being
+    committed, so IPackageController.before_index() uses this to leave the
+    summary alone rather than write it again from another connection, which
+    would wait for the package's transaction to release its row lock.
+
+    '''
+    return package_id in _pending_package_ids(session)
+
+
+def _write_package_formats(connection, package_id, formats):
+    connection.execute(package_formats_table.delete().where(
+        package_formats_table.c.package_id == package_id))
+    if formats is not None:
+        connection.execute(package_formats_table.insert().values(
+            package_id=package_id, formats=json.dumps(formats)))
+
+
+def _pending_package_ids(session):
+    if isinstance(session, sa.orm.scoped_session):
+        session = session()
+    pending = getattr(session, '_birmingham_pending_package_ids', None)
+    if pending is None:
+        pending = session._birmingham_pending_package_ids = set()
+        _listen_for_transaction_end()
+    return pending
+
+
+_listening_for_transaction_end = False
+
+
+def _listen_for_transaction_end():
+    global _listening_for_transaction_end
+    if _listening_for_transaction_end:
+        return
+    for event in ('after_commit', 'after_rollback'):
+        sa.event.listen(sa.orm.Session, event, _forget_pending_package_ids)
+    _listening_for_transaction_end = True
+
+
+def _forget_pending_package_ids(session):
+    session._birmingham_pending_package_ids = None
+
+
+def package_formats(package_ids):
+    '''Return the resource formats summaries of the given packages.
+
+    Packages that don't have a summary yet are left out of the result.
+
+    :returns: a dict mapping package ids to lists of formats
+    :rtype: dict
+
+    '''
+    if not package_ids:
+        return {}
+    query = sa.select([package_formats_table.c.package_id,
+                       package_formats_table.c.formats]).where(
+        package_formats_table.c.package_id.in_(package_ids))
+    return dict((row.package_id, json.loads(row.formats))
+                for row in model.Session.execute(query))
+
+
+def get_counter(connection, name):
+    '''Return the value of the named counter, or None if it isn't set.'''
+    query = sa.select([counters_table.c.value]).where(
+        counters_table.c.name == name)
+    return connection.execute(query).scalar()
+
+
+def set_counter(connection, name, value):
+    '''Set the named counter to value, creating it if needed.
+
+    :param connection: the connection or session to write with, in the
+                       caller's transaction
+
+    '''
+    update = counters_table.update().where(
+        counters_table.c.name == name).values(
+            value=value, modified=datetime.datetime.utcnow())
+    if connection.execute(update).rowcount:
+        return
+    if isinstance(connection, (sa.orm.Session, sa.orm.scoped_session)):
+        connection = connection.connection()
+    # Insert in a savepoint, so that if another transaction inserts the
+    # counter first only the savepoint is rolled back, not the caller's
+    # transaction.
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(counters_table.insert().values(
+            name=name, value=value, modified=datetime.datetime.utcnow()))
+        savepoint.commit()
+    except sa.exc.IntegrityError:
+        # Another process created it first.
+        savepoint.rollback()
+        connection.execute(update)
+
+
+def add_to_counter(connection, name, delta):
+    '''Add delta to the named counter.
+
+    Does nothing if the counter isn't set, it's up to the counter's reader to
+    initialize it.
+
+    '''
+    connection.execute(counters_table.update().where(
+        counters_table.c.name == name).values(
+            value=counters_table.c.value + delta,
+            modified=datetime.datetime.utcnow()))
+
+
+def get_counter_row(connection, name):
+    '''Return the (value, modified) row of the named counter, or None.'''
+    query = sa.select([counters_table.c.value,
+                       counters_table.c.modified]).where(
+        counters_table.c.name == name)
+    return connection.execute(query).first()
+
+
+def get_or_create_counter(name, initial=1):
+    '''Return the (value, modified) row of the named counter.
+
+    If the counter isn't set yet, it's created with the initial value, in a
+    transaction of its own.
+
+    '''
+    with model.meta.engine.connect() as connection:
+        row = get_counter_row(connection, name)
+        if row is not None:
+            return row
+        try:
+            with connection.begin():
+                connection.execute(counters_table.insert().values(
+                    name=name, value=initial,
+                    modified=datetime.datetime.utcnow()))
+        except sa.exc.IntegrityError:
+            # Another process created it first.
+            pass
+        return get_counter_row(connection, name)
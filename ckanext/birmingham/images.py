@@ -0,0 +1,142 @@
+'''Resized variants of the homepage's featured image.'''
+import hashlib
+import logging
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+import ckanext.birmingham.assets as assets
+
+log = logging.getLogger(__name__)
+
+# The size of the box that the featured image is shown in, in CSS pixels.
+FEATURED_IMAGE_SIZE = (420, 220)
+
+# The pixel densities that variants are made for.
+DENSITIES = (1, 2)
+
+# The formats that variants are made in, most preferred first, as
+# (PIL format, mimetype, file extension). Formats that the installed PIL
+# can't write are skipped.
+FORMATS = (
+    ('WEBP', 'image/webp', 'webp'),
+    ('JPEG', 'image/jpeg', 'jpeg'),
+)
+
+PUBLIC_DIRECTORY = os.path.join(os.path.dirname(__file__), 'public')
+
+# Where the variants are written, inside the public directory so CKAN serves
+# them, and the URL path they're served at.
+DERIVATIVES_DIRECTORY = os.path.join(PUBLIC_DIRECTORY, 'featured')
+DERIVATIVES_URL = '/featured'
+
+# Older PILs call the Lanczos filter ANTIALIAS.
+_RESAMPLE = getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', None))
+
+
+def find_public_file(url_path, config):
+    '''Return the local path of a file served from a CKAN public directory.
+
+    :param url_path: the file's URL path, e.g.
+                     ``/birmingham_featured_image.jpeg``
+    :returns: the path, or None if url_path isn't a local path or the file
+              isn't in any public directory
+
+    '''
+    if not url_path.startswith('/') or url_path.startswith('//'):
+        return None
+    directories = [directory.strip() for directory in
+                   config.get('extra_public_paths', '').split(',')
+                   if directory.strip()]
+    directories.append(PUBLIC_DIRECTORY)
+    for directory in directories:
+        path = os.path.join(directory, url_path.lstrip('/'))
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def build_derivatives(source, directory=DERIVATIVES_DIRECTORY,
+                      url=DERIVATIVES_URL, size=FEATURED_IMAGE_SIZE):
+    '''Write resized variants of an image, and return their sources.
+
+    A variant is made for each of DENSITIES and FORMATS, cropped to the
+    size's aspect ratio. The variants' file names include a hash of the
+    source image, so they're only written the first time they're asked for
+    and they change when the image does. Variants in the public directory
+    are linked with their fingerprinted URLs (see assets.asset_url()), so
+    browsers cache them for good. Images are never scaled up, so
+    densities that the source is too small for are skipped, and a source
+    that's smaller than size gets no variants at all (so the original is
+    shown as it is).
+
+    :param source: the path of the image
+    :returns: one dict per format, with the format's mimetype (``type``) and
+              the variants' ``srcset``, most preferred first. Empty if PIL
+              isn't installed or the image is smaller than size.
+    :rtype: list of dicts
+
+    '''
+    if Image is None:
+        log.info('PIL is not installed, not resizing the featured image')
+        return []
+    with open(source, 'rb') as file_:
+        digest = hashlib.sha1(file_.read()).hexdigest()[:12]
+    image = Image.open(source)
+    Image.init()
+
+    variants = []
+    for pil_format, mimetype, extension in FORMATS:
+        if pil_format not in Image.SAVE:
+            continue
+        candidates = []
+        for density in DENSITIES:
+            width, height = size[0] * density, size[1] * density
+            if image.size[0] < width or image.size[1] < height:
+                continue
+            name = 'featured-{0}-{1}x{2}.{3}'.format(digest, width, height,
+                                                     extension)
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                _save(ImageOps.fit(image.convert('RGB'), (width, height),
+                                   _RESAMPLE),
+                      path, pil_format)
+            candidates.append(('{0}/{1}'.format(url, name), density))
+        if candidates:
+            variants.append((mimetype, candidates))
+
+    # The variants are linked with their fingerprinted URLs, so the manifest
+    # has to know about the ones that were just written.
+    manifest = assets.manifest()
+    if any(name not in manifest
+           for _, candidates in variants for name, _ in candidates):
+        assets.load_manifest()
+    return [{'type': mimetype,
+             'srcset': ', '.join('{0} {1}x'.format(assets.asset_url(name),
+                                                   density)
+                                 for name, density in candidates)}
+            for mimetype, candidates in variants]
+
+
+def _save(image, path, pil_format):
+    # Write to a temporary file and rename it into place, so that other
+    # processes never serve a half-written image.
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file_:
+            image.save(file_, pil_format, quality=85, optimize=True)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
@@ -0,0 +1,166 @@
+'''Latency, query and cache metrics for the birmingham plugins.'''
+import bisect
+import functools
+import threading
+import timeit
+import weakref
+
+import sqlalchemy as sa
+
+from ckanext.birmingham.settings import settings
+
+# The upper bounds of the latency histograms' buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0)
+
+
+class _Stats(object):
+    '''The metrics of one instrumented function.'''
+    __slots__ = ('buckets', 'count', 'seconds', 'queries')
+
+    def __init__(self):
+        # One count per bucket plus one for +Inf, not cumulative.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+
+
+_lock = threading.Lock()
+# Maps (kind, name) to the _Stats of each instrumented function.
+_stats = {}
+# The number of SQL statements run by each thread.
+_queries = threading.local()
+# The engines whose statements are counted.
+_listening_engines = weakref.WeakSet()
+
+
+def instrument(kind, name, func):
+    '''Wrap a helper or auth function so its calls are measured.
+
+    While ckanext.birmingham.metrics is on, each call's latency and number of
+    SQL statements are recorded under (kind, name). While it's off the
+    wrapper just calls func.
+
+    :param kind: what func is, e.g. ``'helper'`` or ``'auth'``
+    :param name: the name func is registered under
+
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not settings.metrics:
+            return func(*args, **kwargs)
+        queries_before = _query_count()
+        start = timeit.default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(kind, name, timeit.default_timer() - start,
+                    _query_count() - queries_before)
+    return wrapper
+
+
+def instrument_all(kind, functions):
+    '''Return a copy of a get_helpers() or get_auth_functions() dict with
+    every function instrumented.
+
+    '''
+    return dict((name, instrument(kind, name, func))
+                for name, func in functions.items())
+
+
+def listen_for_queries(engine):
+    '''Count the SQL statements run on the given engine, per thread.
+
+    Call it for each engine that the instrumented functions query, e.g. the
+    read replica's too.
+
+    '''
+    if engine in _listening_engines:
+        return
+    sa.event.listen(engine, 'before_cursor_execute', _count_query)
+    _listening_engines.add(engine)
+
+
+def reset():
+    '''Forget all the recorded metrics.'''
+    with _lock:
+        _stats.clear()
+
+
+def prometheus_text(caches=()):
+    '''Return the recorded metrics in the Prometheus text exposition format.
+
+    :param caches: the TTLCaches whose hits and misses to include, as
+                   (name, cache) pairs
+
+    '''
+    with _lock:
+        stats = sorted((key, _copy(value)) for key, value in _stats.items())
+
+    lines = [
+        '# HELP birmingham_call_duration_seconds Latency of the birmingham '
+        'plugins\' helpers and auth functions.',
+        '# TYPE birmingham_call_duration_seconds histogram',
+    ]
+    for (kind, name), value in stats:
+        labels = 'kind="{0}",name="{1}"'.format(kind, name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), value.buckets):
+            cumulative += count
+            lines.append(
+                'birmingham_call_duration_seconds_bucket{{{0},le="{1}"}} '
+                '{2}'.format(labels, bound, cumulative))
+        lines.append('birmingham_call_duration_seconds_sum{{{0}}} {1!r}'
+                     .format(labels, value.seconds))
+        lines.append('birmingham_call_duration_seconds_count{{{0}}} {1}'
+                     .format(labels, value.count))
+
+    lines.extend([
+        '# HELP birmingham_call_queries_total SQL statements run by the '
+        'birmingham plugins\' helpers and auth functions.',
+        '# TYPE birmingham_call_queries_total counter',
+    ])
+    for (kind, name), value in stats:
+        lines.append('birmingham_call_queries_total{{kind="{0}",name="{1}"}} '
+                     '{2}'.format(kind, name, value.queries))
+
+    for metric, attribute, help_ in (
+            ('birmingham_cache_hits_total', 'hits',
+             'Lookups that found a value in the birmingham caches.'),
+            ('birmingham_cache_misses_total', 'misses',
+             'Lookups that had to compute a value for the birmingham '
+             'caches.')):
+        lines.append('# HELP {0} {1}'.format(metric, help_))
+        lines.append('# TYPE {0} counter'.format(metric))
+        for name, ttl_cache in caches:
+            lines.append('{0}{{cache="{1}"}} {2}'.format(
+                metric, name, getattr(ttl_cache, attribute)))
+    return '\n'.join(lines) + '\n'
+
+
+def _record(kind, name, seconds, queries):
+    with _lock:
+        stats = _stats.get((kind, name))
+        if stats is None:
+            stats = _stats[(kind, name)] = _Stats()
+        stats.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        stats.count += 1
+        stats.seconds += seconds
+        stats.queries += queries
+
+
+def _copy(stats):
+    copy = _Stats()
+    copy.buckets = list(stats.buckets)
+    copy.count, copy.seconds, copy.queries = (stats.count, stats.seconds,
+                                              stats.queries)
+    return copy
+
+
+def _count_query(*args, **kwargs):
+    _queries.count = getattr(_queries, 'count', 0) + 1
+
+
+def _query_count():
+    return getattr(_queries, 'count', 0)
@@ -0,0 +1,216 @@
+'''WSGI middleware added by the birmingham plugin.'''
+import calendar
+import datetime
+import email.utils
+import hashlib
+import mimetypes
+import re
+import uuid
+
+import pkg_resources
+import webob
+
+import ckanext.birmingham.assets as assets
+import ckanext.birmingham.db as db
+from ckanext.birmingham.settings import settings
+
+# The name of the counter that's bumped whenever a package, group or
+# organization changes.
+CONTENT_REVISION_COUNTER = 'content_revision'
+
+# The pages that depend only on the site's content and the birmingham
+# settings: the homepage and the dataset list. CKAN's I18nMiddleware has
+# already taken any locale out of the path, into environ['CKAN_LANG'].
+CONDITIONAL_GET_PATH = re.compile(r'^/(dataset/?)?$')
+
+
+class ConditionalGetMiddleware(object):
+    '''Answers conditional GETs of the homepage and dataset list with 304s.
+
+    The homepage and the dataset list only change when a package, group or
+    organization or the site's config does (or when the birmingham settings,
+    the locale or the deployed code do), so anonymous responses to them get
+    an ETag and a Last-Modified header built from the site's content revision
+    counter and from when this process first saw the current settings and
+    code. When a request's If-None-Match or
+    If-Modified-Since header shows that the client already has the current
+    revision, a 304 is returned without calling CKAN at all, so no templates
+    are rendered and no helpers are called.
+
+    Logged-in users, and anonymous users with a session (e.g. with flash
+    messages waiting), always get the page rendered by CKAN.
+
+    '''
+    def __init__(self, app, config):
+        self.app = app
+        self.session_cookies = (
+            config.get('who.cookie_name', 'auth_tkt'),
+            config.get('beaker.session.key', 'ckan'),
+        )
+        self.release = _release()
+        # The ETag's inputs other than the content revision and the request,
+        # and when this process first saw them, so that Last-Modified changes
+        # when they do (e.g. after a restart with new settings or templates).
+        self._inputs = None
+        self._inputs_changed = None
+
+    def __call__(self, environ, start_response):
+        request = webob.Request(environ)
+        if not self._is_conditional(request):
+            return self.app(environ, start_response)
+
+        value, modified = db.get_or_create_counter(CONTENT_REVISION_COUNTER)
+        etag = _etag(value, request, self.release)
+        modified = max(modified, self._last_input_change())
+        last_modified = email.utils.formatdate(
+            calendar.timegm(modified.utctimetuple()), usegmt=True)
+        headers = [('ETag', etag), ('Last-Modified', last_modified)]
+
+        if _not_modified(request, etag, modified):
+            start_response('304 Not Modified', headers)
+            return []
+
+        def _start_response(status, response_headers, exc_info=None):
+            if status.startswith('200'):
+                names = set(name.lower() for name, _ in response_headers)
+                response_headers = response_headers + [
+                    header for header in headers
+                    if header[0].lower() not in names]
+            return start_response(status, response_headers, exc_info)
+
+        return self.app(environ, _start_response)
+
+    def _last_input_change(self):
+        inputs = (settings.fingerprint(), self.release,
+                  assets.manifest_digest())
+        if inputs != self._inputs:
+            # HTTP dates only have whole seconds, so make sure each change
+            # gets a later one than the one before.
+            now = datetime.datetime.utcnow().replace(microsecond=0)
+            previous = self._inputs_changed
+            if previous is not None and now <= previous:
+                now = previous + datetime.timedelta(seconds=1)
+            self._inputs, self._inputs_changed = inputs, now
+        return self._inputs_changed
+
+    def _is_conditional(self, request):
+        if not settings.conditional_get:
+            return False
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if not CONDITIONAL_GET_PATH.match(request.path_info):
+            return False
+        return not any(name in request.cookies
+                       for name in self.session_cookies)
+
+
+class AssetMiddleware(object):
+    '''Serves the extension's static files at their fingerprinted URLs.
+
+    See assets.asset_url(). CKAN serves the public directories before
+    plugins' middleware is called, but the fingerprinted URLs aren't in any
+    public directory so they reach this middleware. Files requested with
+    their current hash are cached by browsers for a year without being
+    revalidated. Files requested with an old hash (e.g. by a page cached
+    before a deploy) get the current file, without the long-lived headers.
+    Compressible files are served from their precompressed siblings (see
+    assets.compress_static_files()) when the browser accepts them.
+
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        found = assets.lookup(environ.get('PATH_INFO', ''))
+        if found is None:
+            if environ.get('PATH_INFO', '').startswith(assets.PREFIX + '/'):
+                start_response('404 Not Found',
+                               [('Content-Type', 'text/plain')])
+                return [b'Not found']
+            return self.app(environ, start_response)
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed',
+                           [('Allow', 'GET, HEAD'),
+                            ('Content-Type', 'text/plain')])
+            return [b'Method not allowed']
+
+        name, path, current_digest, digest = found
+        content_type = mimetypes.guess_type(name)[0]
+        headers = [
+            ('Content-Type', content_type or 'application/octet-stream'),
+        ]
+        if path.endswith(assets.COMPRESSIBLE_EXTENSIONS):
+            headers.append(('Vary', 'Accept-Encoding'))
+            variant = assets.precompressed(
+                path, environ.get('HTTP_ACCEPT_ENCODING'))
+            if variant is not None:
+                encoding, path = variant
+                headers.append(('Content-Encoding', encoding))
+        with open(path, 'rb') as file_:
+            body = file_.read()
+        headers.append(('Content-Length', str(len(body))))
+        if digest == current_digest:
+            headers.append(('Cache-Control',
+                            'public, max-age=31536000, immutable'))
+        else:
+            headers.append(('Cache-Control', 'no-cache'))
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
+
+
+def bump_content_revision(connection):
+    '''Bump the content revision counter.
+
+    Call this once the change to the content is committed, in a short
+    transaction of its own: the update holds the counter's row lock until
+    its transaction ends, and every other change waits for it.
+
+    '''
+    db.add_to_counter(connection, CONTENT_REVISION_COUNTER, 1)
+
+
+def _etag(revision, request, release):
+    # The page also depends on the locale, the path and query string (the
+    # search and page), the birmingham settings, and the deployed templates
+    # and static files. It's a weak ETag because the page is equivalent but
+    # not necessarily byte-for-byte the same.
+    key = repr((revision, request.environ.get('CKAN_LANG'),
+                request.path_info, request.query_string,
+                settings.fingerprint(), release, assets.manifest_digest()))
+    return 'W/"{0}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _release():
+    # The versions of the extension and of CKAN, so that a deploy that
+    # changes the templates changes the ETags. If the extension isn't
+    # installed as a distribution, a token for this process is used instead.
+    import ckan
+    try:
+        version = pkg_resources.get_distribution('ckanext-birmingham').version
+    except pkg_resources.DistributionNotFound:
+        version = uuid.uuid4().hex
+    return '{0}/{1}'.format(version, ckan.__version__)
+
+
+def _not_modified(request, etag, modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since.
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or _strip_weak(etag) in map(_strip_weak, tags)
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since is None:
+            return False
+        return (calendar.timegm(modified.utctimetuple()) <=
+                email.utils.mktime_tz(since))
+    return False
+
+
+def _strip_weak(etag):
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
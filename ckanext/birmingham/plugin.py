@@ -1,30 +1,305 @@
+import atexit
+import contextlib
+import itertools
+import logging
+import re
+
 import pylons.config as config
+import sqlalchemy as sa
+import sqlalchemy.orm
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import ckan.logic as logic
+import ckan.lib.search as search
+
+import ckanext.birmingham.assets as assets
+import ckanext.birmingham.cache as cache
+import ckanext.birmingham.db as db
+import ckanext.birmingham.metrics as metrics
+import ckanext.birmingham.middleware as middleware
+from ckanext.birmingham.settings import settings
+
+log = logging.getLogger(__name__)
 
 
-def editors_and_admins():
+def editors_and_admins(session=None):
     '''Return the IDs of all group or organization editors and admins.
 
     Return a list of the user IDs of all users who are editors or admins of one
     or more groups or organizations.
 
+    :param session: the session to query (optional, default: the read replica
+                    if there is one, see db.read_session())
+
     '''
     import ckan.model
-    query = ckan.model.Session.query(ckan.model.Member)
-    query = query.filter_by(table_name='user')
-    query = query.filter(ckan.model.Member.capacity.in_(('editor', 'admin')))
-    return list(set([member.table_id for member in query.all()]))
+    with _session_or_read_session(session) as session:
+        query = session.query(ckan.model.Member.table_id)
+        query = query.filter_by(table_name='user')
+        query = query.filter(
+            ckan.model.Member.capacity.in_(('editor', 'admin')))
+        return list(set([table_id for (table_id,) in query.all()]))
+
+
+def sysadmins(session=None):
+    '''Return a list of the user IDs of all the site's syadmin users.
+
+    :param session: the session to query (optional, default: the read replica
+                    if there is one, see db.read_session())
+
+    '''
+    import ckan.model
+    with _session_or_read_session(session) as session:
+        query = session.query(ckan.model.User.id)
+        query = query.filter_by(sysadmin=True)
+        return [user_id for (user_id,) in query.all()]
+
+
+@contextlib.contextmanager
+def _session_or_read_session(session):
+    if session is not None:
+        yield session
+    else:
+        with db.read_session() as session:
+            yield session
+
+
+def _editor_ids(user_ids=None):
+    '''Return a selectable of the ids of all the site's "editors".
+
+    An "editor" is any group/org editor or admin, or sysadmin. If user_ids is
+    given only those of the given users who are editors are selected.
+
+    '''
+    import ckan.model
+    member_table = ckan.model.member_table
+    user_table = ckan.model.user_table
+    editor_ids = sa.select([member_table.c.table_id.label('user_id')]).where(
+        sa.and_(member_table.c.table_name == 'user',
+                member_table.c.capacity.in_(('editor', 'admin'))))
+    sysadmin_ids = sa.select([user_table.c.id.label('user_id')]).where(
+        user_table.c.sysadmin == True)
+    if user_ids is not None:
+        editor_ids = editor_ids.where(
+            member_table.c.table_id.in_(user_ids))
+        sysadmin_ids = sysadmin_ids.where(user_table.c.id.in_(user_ids))
+    return sa.union(editor_ids, sysadmin_ids).alias('editor_ids')
+
+
+def count_editors_and_sysadmins(connection=None):
+    '''Return the number of group or organization editors, admins and
+    sysadmins.
+
+    Users who are editors or admins of several groups or organizations, or
+    who are also sysadmins, are only counted once. The count is done with a
+    single query, without loading any Member or User objects.
+
+    :param connection: the connection or session to query with (optional,
+                       default: ckan.model.Session)
+
+    :rtype: int
+
+    '''
+    import ckan.model
+    if connection is None:
+        connection = ckan.model.Session
+    ids = _editor_ids()
+    query = sa.select([sa.func.count(sa.distinct(ids.c.user_id))])
+    return connection.execute(query).scalar()
+
+
+def editor_count(for_update=False):
+    '''Return the number of editors from the maintained editor counter.
+
+    This reads a single row. The counter is kept up to date as memberships
+    and sysadmins change (see _after_flush()), and is initialized from
+    count_editors_and_sysadmins() the first time it's read.
+
+    :param for_update: if True, first wait for any other transaction that's
+                       checking the editor cap to end, and keep others waiting
+                       until the current transaction ends (see
+                       _lock_editor_cap()) (optional, default: False)
+    :type for_update: bool
+
+    :rtype: int
+
+    '''
+    import ckan.model
+    if for_update:
+        _lock_editor_cap()
+    count = db.get_counter(ckan.model.Session, EDITOR_COUNTER)
+    if count is None:
+        if for_update:
+            # The current transaction holds the lock, so initialize the
+            # counter in it: reconcile_editor_count() would wait for the lock
+            # forever.
+            count = count_editors_and_sysadmins(ckan.model.Session)
+            db.set_counter(ckan.model.Session, EDITOR_COUNTER, count)
+        else:
+            count = reconcile_editor_count()
+    return count
+
+
+# The key of the PostgreSQL advisory lock that serializes editor cap checks,
+# an arbitrary number that other code is unlikely to use.
+EDITOR_CAP_LOCK_KEY = 7303196852
+
+
+def _lock_editor_cap(connection=None):
+    '''Lock the editor cap until the current transaction ends.
+
+    Without this, several requests adding editors at the same time could all
+    see room for one more editor and go past the cap together. This takes a
+    transaction-level PostgreSQL advisory lock, so the next request to check
+    the cap waits until the transaction that's adding an editor has committed
+    (and updated the editor counter) or rolled back. Only requests that add
+    editors, transactions that change the editor counter and
+    reconcile_editor_count() take the lock, so creating other members never
+    waits for it.
+
+    Does nothing on databases other than PostgreSQL.
+
+    :param connection: the connection or session whose transaction takes the
+                       lock (optional, default: ckan.model.Session)
+
+    '''
+    import ckan.model
+    if ckan.model.meta.engine.dialect.name != 'postgresql':
+        return
+    if connection is None:
+        connection = ckan.model.Session
+    connection.execute(sa.text('SELECT pg_advisory_xact_lock(:key)'),
+                       {'key': EDITOR_CAP_LOCK_KEY})
+
+
+def reconcile_editor_count():
+    '''Rebuild the maintained editor counter from the Member and User tables.
+
+    The counter is counted, written and committed in a transaction of its
+    own that holds the editor cap lock (see _lock_editor_cap()), so it waits
+    for any transaction that's changing the editors to commit rather than
+    overwrite its change to the counter with a count that's missing it.
+
+    :returns: the number of editors
+    :rtype: int
+
+    '''
+    import ckan.model
+    with ckan.model.meta.engine.begin() as connection:
+        _lock_editor_cap(connection)
+        count = count_editors_and_sysadmins(connection)
+        db.set_counter(connection, EDITOR_COUNTER, count)
+    return count
+
+
+EDITOR_COUNTER = 'editors'
+
 
+def _changed_editor_objects(session):
+    '''Return the pending Member and User objects that may change who is an
+    editor when the session is flushed.
 
-def sysadmins():
-    '''Return a list of the user IDs of all the site's syadmin users.'''
+    '''
     import ckan.model
-    query = ckan.model.Session.query(ckan.model.User)
-    query = query.filter_by(sysadmin=True)
-    return [user.id for user in query.all()]
+    objects = []
+    for obj in session.new:
+        if isinstance(obj, ckan.model.Member) and obj.table_name == 'user':
+            objects.append(obj)
+        elif isinstance(obj, ckan.model.User) and obj.sysadmin:
+            objects.append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, ckan.model.Member):
+            attributes = ('capacity', 'table_id', 'table_name')
+        elif isinstance(obj, ckan.model.User):
+            attributes = ('sysadmin',)
+        else:
+            continue
+        for attribute in attributes:
+            history = sa.orm.attributes.get_history(obj, attribute)
+            if history.has_changes():
+                objects.append(obj)
+                break
+    for obj in session.deleted:
+        if isinstance(obj, ckan.model.Member) and obj.table_name == 'user':
+            objects.append(obj)
+    return objects
+
+
+def _user_ids(objects):
+    '''Return the ids of the users that the given Members and Users are about.
+
+    Also returns the previous user id of Members whose user was changed.
+
+    '''
+    import ckan.model
+    user_ids = set()
+    for obj in objects:
+        if isinstance(obj, ckan.model.Member):
+            history = sa.orm.attributes.get_history(obj, 'table_id')
+            user_ids.update(history.sum())
+        user_ids.add(obj.id if isinstance(obj, ckan.model.User)
+                     else obj.table_id)
+    user_ids.discard(None)
+    return user_ids
+
+
+def _current_editors(session, user_ids):
+    '''Return those of user_ids that are currently editors.'''
+    if not user_ids:
+        return set()
+    ids = _editor_ids(user_ids)
+    return set(row[0] for row in session.execute(sa.select([ids.c.user_id])))
+
+
+def _before_flush(session, flush_context, instances):
+    '''Remember which of the users about to be changed are editors.'''
+    # Always replace the snapshot, so one left behind by a flush that failed
+    # is never diffed against.
+    session._birmingham_editors_before = None
+    objects = _changed_editor_objects(session)
+    if objects:
+        session._birmingham_editors_before = (
+            objects, _current_editors(session, _user_ids(objects)))
+
+
+def _after_flush(session, flush_context):
+    '''Update the editor counter with the difference the flush made.'''
+    before = getattr(session, '_birmingham_editors_before', None)
+    if before is None:
+        return
+    session._birmingham_editors_before = None
+    objects, editors_before = before
+    editors_after = _current_editors(session, _user_ids(objects))
+    delta = len(editors_after) - len(editors_before)
+    if delta:
+        # Hold the lock until the change is committed, so that
+        # reconcile_editor_count() can't count the editors without it and
+        # then overwrite the counter.
+        _lock_editor_cap(session)
+        if db.get_counter(session, EDITOR_COUNTER) is None:
+            db.set_counter(session, EDITOR_COUNTER,
+                           count_editors_and_sysadmins(session))
+        else:
+            db.add_to_counter(session, EDITOR_COUNTER, delta)
+
+
+def _forget_editors_before(session):
+    session._birmingham_editors_before = None
+
+
+def _listen_for_editor_changes():
+    '''Keep the editor counter up to date whenever any session is flushed.'''
+    global _listening_for_editor_changes
+    if _listening_for_editor_changes:
+        return
+    sa.event.listen(sa.orm.Session, 'before_flush', _before_flush)
+    sa.event.listen(sa.orm.Session, 'after_flush', _after_flush)
+    sa.event.listen(sa.orm.Session, 'after_rollback', _forget_editors_before)
+    _listening_for_editor_changes = True
+
+
+_listening_for_editor_changes = False
 
 
 def _member_create(data_dict, result, max_editors):
@@ -61,9 +336,9 @@ def _member_create(data_dict, result, max_editors):
 
     # If the site has >= max_editors group or org editors or admins and
     # sysadmins, then don't allow another group or org editor or admin to be
-    # created.
-    editors_and_sysadmins = set(editors_and_admins() + sysadmins())
-    if len(editors_and_sysadmins) >= max_editors:
+    # created. The cap stays locked until this request's transaction ends, so
+    # concurrent requests can't all get past it at once.
+    if editor_count(for_update=True) >= max_editors:
         msg = toolkit._("You're only allowed to have {n} editors").format(
             n=max_editors)
         return {'success': False, 'msg': msg}
@@ -77,7 +352,7 @@ def _max_editors():
     '''Return the maximum number of editors allowed for this site (int).
 
     '''
-    return toolkit.asint(config.get('ckan.birmingham.max_editors', 3))
+    return settings.max_editors
 
 
 def member_create(context, data_dict):
@@ -97,15 +372,181 @@ def member_create(context, data_dict):
     return _member_create(data_dict, result, _max_editors())
 
 
+def member_create_many_auth(context, data_dict):
+    '''Auth function for the birmingham_member_create_many action.
+
+    Any logged-in user may call the action, each of the memberships is then
+    checked against the core member_create auth function and the editor cap
+    by the action itself.
+
+    '''
+    if not context.get('user'):
+        return {'success': False,
+                'msg': toolkit._('You must be logged in to add members')}
+    return {'success': True}
+
+
+def member_create_many(context, data_dict):
+    '''Add many users to groups or organizations in one go.
+
+    Works like calling member_create once for each membership, but the site's
+    editors are only looked up once for the whole batch, and all of the
+    memberships that are allowed are committed together in one transaction.
+
+    Each membership is checked against the core member_create auth function
+    and the up_to_n_editors cap, in order: once the cap is reached, any
+    further memberships that would add an editor are refused.
+
+    :param members: the memberships to create, each a dict with the ``id`` of
+                    the group or organization, the id or name of the user as
+                    ``object``, and the ``capacity`` (e.g. ``'member'``,
+                    ``'editor'`` or ``'admin'``)
+    :type members: list of dicts
+
+    :returns: one result per membership, in the same order:
+              ``{'success': True, 'group': ..., 'user': ..., 'capacity': ...}``
+              or ``{'success': False, 'msg': ...}``, where msg is the
+              error dict of a ValidationError (e.g.
+              ``{'capacity': ['Missing value']}``) for memberships with
+              missing fields, or a message
+    :rtype: list of dicts
+
+    '''
+    model = context['model']
+    toolkit.check_access('birmingham_member_create_many', context, data_dict)
+    members = toolkit.get_or_bust(data_dict, 'members')
+    if not isinstance(members, list):
+        raise toolkit.ValidationError({'members': ['Must be a list']})
+    if not all(isinstance(member_dict, dict) for member_dict in members):
+        raise toolkit.ValidationError(
+            {'members': ['Each member must be a dict']})
+
+    max_editors = _max_editors()
+    editors = None
+    try:
+        if any(member_dict.get('capacity') in ('editor', 'admin')
+               for member_dict in members):
+            # Lock the cap for the whole batch, see _lock_editor_cap().
+            _lock_editor_cap()
+            # Read the editors from the primary, a replica might not have
+            # the latest memberships yet.
+            editors = _editor_memberships(model.Session)
+
+        rev = model.repo.new_revision()
+        rev.author = context['user']
+
+        results = [_member_create_one(context, member_dict, editors,
+                                      max_editors)
+                   for member_dict in members]
+        if any(result['success'] for result in results):
+            model.repo.commit()
+        else:
+            # Release the editor cap lock and the unused revision.
+            model.Session.rollback()
+    except Exception:
+        model.Session.rollback()
+        raise
+    return results
+
+
+def _editor_memberships(session):
+    '''Return the groups and organizations that each editor is an editor or
+    admin of.
+
+    :returns: a dict mapping the ids of the site's editors to sets of group
+              ids. Sysadmins' sets also contain None, so they stay editors
+              whatever memberships they lose.
+    :rtype: dict
+
+    '''
+    import ckan.model
+    query = session.query(ckan.model.Member.table_id,
+                          ckan.model.Member.group_id)
+    query = query.filter_by(table_name='user')
+    query = query.filter(ckan.model.Member.capacity.in_(('editor', 'admin')))
+    editors = {}
+    for user_id, group_id in query.all():
+        editors.setdefault(user_id, set()).add(group_id)
+    for user_id in sysadmins(session):
+        editors.setdefault(user_id, set()).add(None)
+    return editors
+
+
+def _member_create_one(context, member_dict, editors, max_editors):
+    '''Add one of the memberships of a member_create_many() batch.
+
+    The new member is added to the session but not committed.
+
+    :param editors: the site's editors and their editor memberships, as
+                    returned by _editor_memberships(), or None if the batch
+                    doesn't make anyone an editor. It's updated with this
+                    membership, so users made editors by it are added and
+                    users who no longer have any editor membership (and
+                    aren't sysadmins) are removed.
+    :type editors: dict
+
+    '''
+    import ckan.logic.auth.create
+    model = context['model']
+
+    try:
+        group_id, user_id, capacity = toolkit.get_or_bust(
+            member_dict, ['id', 'object', 'capacity'])
+    except toolkit.ValidationError as e:
+        return {'success': False, 'msg': e.error_dict}
+    group = model.Group.get(group_id)
+    if not group:
+        return {'success': False, 'msg': toolkit._('Group was not found.')}
+    user = model.User.get(user_id)
+    if not user:
+        return {'success': False, 'msg': toolkit._('User was not found.')}
+
+    # The core auth function caches the group in the context, so each
+    # membership needs a context of its own.
+    member_context = dict(context)
+    member_context.pop('group', None)
+    if not member_context.get('ignore_auth'):
+        result = ckan.logic.auth.create.member_create(
+            member_context, {'id': group.id, 'object': user.id,
+                             'object_type': 'user', 'capacity': capacity})
+        if not result['success']:
+            return result
+
+    if capacity in ('editor', 'admin') and not editors.get(user.id):
+        if sum(1 for groups in editors.values() if groups) >= max_editors:
+            msg = toolkit._("You're only allowed to have {n} editors").format(
+                n=max_editors)
+            return {'success': False, 'msg': msg}
+
+    member = model.Session.query(model.Member).filter(
+        model.Member.table_name == 'user').filter(
+        model.Member.table_id == user.id).filter(
+        model.Member.group_id == group.id).filter(
+        model.Member.state == 'active').first()
+    if not member:
+        member = model.Member(table_name='user', table_id=user.id,
+                              group_id=group.id, state='active')
+    member.capacity = capacity
+    model.Session.add(member)
+    if editors is not None:
+        groups = editors.setdefault(user.id, set())
+        if capacity in ('editor', 'admin'):
+            groups.add(group.id)
+        else:
+            groups.discard(group.id)
+    return {'success': True, 'group': group.name, 'user': user.name,
+            'capacity': capacity}
+
+
 def get_featured_org_no_limit(count=1):
     '''Returns a list of favourite organization in the form
     of organization_list action function
     '''
-    config_orgs = config.get('ckan.featured_orgs', '').split()
-    orgs = featured_group_org_no_limit(get_action='organization_show',
+    orgs = featured_group_org_no_limit(is_organization=True,
                               list_action='organization_list',
                               count=count,
-                              items=config_orgs)
+                              items=settings.featured_orgs,
+                              auto=settings.featured_orgs_auto)
     return orgs
 
 
@@ -113,57 +554,584 @@ def get_featured_groups_no_limit(count=1):
     '''Returns a list of favourite group the form
     of organization_list action function
     '''
-    config_groups = config.get('ckan.featured_groups', '').split()
-    groups = featured_group_org_no_limit(get_action='group_show',
+    groups = featured_group_org_no_limit(is_organization=False,
                                 list_action='group_list',
                                 count=count,
-                                items=config_groups)
+                                items=settings.featured_groups,
+                                auto=settings.featured_groups_auto)
     return groups
 
 
-def featured_group_org_no_limit(items, get_action, list_action, count):
-    def get_group(id):
-        context = {'ignore_auth': True,
-                   'for_view': True}
-        data_dict = {'id': id,
-                     'include_datasets': True}
+# The featured groups and organizations are shared by all requests, they're
+# cleared whenever a group, organization or package changes.
+_featured_cache = cache.TTLCache(name='featured')
+
+
+def featured_group_org_no_limit(items, is_organization, list_action, count,
+                                auto=''):
+    '''Return up to count featured groups or organizations.
+
+    The configured items come first, followed by the site's other groups or
+    organizations: in alphabetical order, or with the most datasets first if
+    auto is ``'by_dataset_count'``. The groups are returned as
+    group_summaries() dicts, not full group_show dicts. Results are cached
+    across requests for ckanext.birmingham.featured_cache_ttl seconds.
+
+    '''
+    key = (is_organization, list_action, count, tuple(items), auto)
+    groups = cache.cached(_featured_cache, key, _featured_group_org_no_limit,
+                          items, is_organization, list_action, count, auto)
+    return list(groups)
 
-        try:
-            out = logic.get_action(get_action)(context, data_dict)
-        except logic.NotFound:
-            return None
-        return out
+
+def _featured_group_org_no_limit(items, is_organization, list_action, count,
+                                 auto=''):
+    '''Return up to count featured groups or organizations, uncached.
+
+    The configured items are all resolved with one group_summaries() query,
+    however many of them there are and whether or not they exist. The site's
+    other groups are then resolved lazily, count at a time, so they're only
+    paged through list_action if the configured items aren't enough and only
+    until count groups have been found.
+
+    With auto set to ``'by_dataset_count'`` the configured items are followed
+    by the groups with the most datasets, from a single search facet query,
+    and they're resolved in the same group_summaries() query as the
+    configured items. The alphabetical list is still used if there aren't
+    enough of those.
+
+    '''
+    if count <= 0:
+        return []
 
     groups_data = []
 
-    extras = logic.get_action(list_action)({}, {})
+    first = list(items)
+    if auto == 'by_dataset_count':
+        first.extend(_top_by_dataset_count(is_organization,
+                                           count + len(items)))
+    first = list(_unique(first))
+    candidates = _unique(itertools.chain(
+        first, _paged_list(list_action, page_size=count)))
 
-    # list of found ids to prevent duplicates
-    found = []
-    for group_name in items + extras:
-        group = get_group(group_name)
-        if not group:
-            continue
-        # check if duplicate
-        if group['id'] in found:
-            continue
-        found.append(group['id'])
-        groups_data.append(group)
-        if len(groups_data) == count:
+    # set of found ids to prevent duplicates, names and ids of the same group
+    # resolve to the same id
+    found = set()
+    batch_size = len(first) or count
+    while True:
+        batch = list(itertools.islice(candidates, batch_size))
+        if not batch:
             break
+        summaries = group_summaries(batch, is_organization)
+        for group_name in batch:
+            group = summaries.get(group_name)
+            if not group:
+                continue
+            # check if duplicate
+            if group['id'] in found:
+                continue
+            found.add(group['id'])
+            groups_data.append(group)
+            if len(groups_data) == count:
+                return groups_data
+        # After the first batch, only ask for as many as are still needed.
+        batch_size = count - len(groups_data)
 
     return groups_data
 
 
+def _top_by_dataset_count(is_organization, limit):
+    '''Return the names of the groups or orgs with the most datasets.
+
+    Uses a single package_search facet query.
+
+    '''
+    field = 'organization' if is_organization else 'groups'
+    try:
+        result = logic.get_action('package_search')(
+            {}, {'q': '*:*', 'rows': 0, 'facet.field': [field],
+                 'facet.limit': limit})
+    except (logic.ValidationError, search.SearchError):
+        return []
+    facet_items = result['search_facets'].get(field, {}).get('items', [])
+    facet_items = sorted(facet_items, key=lambda item: item['count'],
+                         reverse=True)
+    return [item['name'] for item in facet_items[:limit]]
+
+
+def _paged_list(list_action, page_size):
+    '''Yield the names returned by list_action, fetching a page at a time.
+
+    Stops early if the action turns out to ignore limit and offset.
+
+    '''
+    offset = 0
+    previous_page = None
+    while True:
+        page = logic.get_action(list_action)(
+            {}, {'limit': page_size, 'offset': offset})
+        if page == previous_page:
+            return
+        for name in page:
+            yield name
+        if len(page) < page_size:
+            return
+        previous_page = page
+        offset += page_size
+
+
+def _unique(iterable):
+    '''Yield the items of iterable, skipping the ones already yielded.'''
+    seen = set()
+    for item in iterable:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def group_summaries(ids_or_names, is_organization):
+    '''Return lightweight dicts of many groups or organizations at once.
+
+    Unlike group_show and organization_show this doesn't dictize any of the
+    group's datasets, users or extras. All the groups, and their dataset
+    counts, are read with a single query.
+
+    Each summary has the group's id, name, title, display_name, type,
+    is_organization, description, image_url, image_display_url and
+    package_count (the number of active, public datasets in the group).
+
+    :param ids_or_names: the ids and/or names of the groups
+    :type ids_or_names: list of strings
+    :param is_organization: whether to look for organizations or groups
+    :type is_organization: bool
+
+    :returns: a dict mapping the ids and names of the active groups that were
+              found to their summaries
+    :rtype: dict
+
+    '''
+    if not ids_or_names:
+        return {}
+
+    with db.read_session() as session:
+        return _group_summaries(session, ids_or_names, is_organization)
+
+
+def _group_summaries(session, ids_or_names, is_organization):
+    import ckan.model
+
+    Group = ckan.model.Group
+    Package = ckan.model.Package
+    Member = ckan.model.Member
+    columns = (Group.id, Group.name, Group.title, Group.type,
+               Group.description, Group.image_url)
+    query = session.query(
+        *(columns + (sa.func.count(sa.distinct(Package.id)),)))
+    public_package = sa.and_(Package.state == 'active',
+                             Package.private == False)
+    if is_organization:
+        query = query.outerjoin(
+            Package, sa.and_(Package.owner_org == Group.id, public_package))
+    else:
+        query = query.outerjoin(
+            Member, sa.and_(Member.group_id == Group.id,
+                            Member.table_name == 'package',
+                            Member.state == 'active'))
+        query = query.outerjoin(
+            Package, sa.and_(Package.id == Member.table_id, public_package))
+    query = query.filter(Group.is_organization == is_organization)
+    query = query.filter(Group.state == 'active')
+    query = query.filter(sa.or_(Group.id.in_(ids_or_names),
+                                Group.name.in_(ids_or_names)))
+    query = query.group_by(*columns)
+
+    summaries = {}
+    for (id_, name, title, type_, description, image_url,
+         package_count) in query:
+        summary = {
+            'id': id_,
+            'name': name,
+            'title': title,
+            'display_name': title or name,
+            'type': type_,
+            'is_organization': is_organization,
+            'description': description,
+            'image_url': image_url,
+            'image_display_url': _image_display_url(image_url),
+            'package_count': package_count,
+        }
+        summaries[id_] = summaries[name] = summary
+    return summaries
+
+
+def _image_display_url(image_url):
+    '''Return the URL of a group image, the same way group_show does.
+
+    Uploaded images are stored as bare file names. The URL is built from
+    ckan.site_url rather than with url_for, so this works outside of a
+    request too.
+
+    '''
+    if image_url and not image_url.startswith(('http://', 'https://')):
+        return '{0}/uploads/group/{1}'.format(
+            config.get('ckan.site_url', '').rstrip('/'), image_url)
+    return image_url
+
+
+# The package ids and names that package_info_many() accepts.
+PACKAGE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+@toolkit.side_effect_free
+def package_info_many(context, data_dict):
+    '''Return the package dicts of many packages at once.
+
+    The packages are fetched from the search index with a single query instead
+    of one package_show call per package. Packages that can't be found (or
+    that the user isn't allowed to see) are left out of the result.
+
+    :param ids: the ids of the packages, at most ckan.search.rows_max
+                (default: 1000) of them
+    :type ids: list of strings
+
+    :returns: a dict mapping package ids to package dicts
+    :rtype: dict
+
+    '''
+    ids = toolkit.get_or_bust(data_dict, 'ids')
+    if isinstance(ids, basestring):
+        ids = ids.split(',')
+    if not isinstance(ids, list):
+        raise toolkit.ValidationError({'ids': ['Must be a list']})
+    for id_ in ids:
+        # The ids go into a Solr query, so only allow the characters that
+        # package ids and names are made of.
+        if not isinstance(id_, basestring) or (
+                id_ and not PACKAGE_ID_PATTERN.match(id_)):
+            raise toolkit.ValidationError(
+                {'ids': ['Not a package id: {0!r}'.format(id_)]})
+    ids = [id_ for id_ in set(ids) if id_]
+    if not ids:
+        return {}
+    rows_max = int(config.get('ckan.search.rows_max', 1000))
+    if len(ids) > rows_max:
+        raise toolkit.ValidationError(
+            {'ids': ['At most {0} ids are allowed'.format(rows_max)]})
+
+    fq = 'id:({0})'.format(' OR '.join('"{0}"'.format(id_) for id_ in ids))
+    result = logic.get_action('package_search')(
+        context, {'fq': fq, 'rows': len(ids)})
+    return dict((pkg['id'], pkg) for pkg in result['results'])
+
+
+def get_package_info_many(packages):
+    '''Fetch the package info of many packages with one query.
+
+    The results are remembered for the rest of the request, so that the
+    get_package_info() calls made for each row of a package list don't
+    have to call package_show.
+
+    :param packages: package ids or package dicts
+    :type packages: list
+
+    :returns: a dict mapping package ids to package dicts
+    :rtype: dict
+
+    '''
+    pkg_ids = [pkg['id'] if isinstance(pkg, dict) else pkg
+               for pkg in packages]
+    store = cache.request_store('package_info')
+    missing = [pkg_id for pkg_id in pkg_ids if pkg_id not in store]
+    if missing:
+        try:
+            store.update(logic.get_action('birmingham_package_info_many')(
+                {}, {'ids': missing}))
+        except (logic.ValidationError, logic.NotAuthorized,
+                search.SearchError):
+            # Fall back to one package_show per package.
+            pass
+    return dict((pkg_id, store[pkg_id]) for pkg_id in pkg_ids
+                if pkg_id in store)
+
+
 def get_package_info(pkg_id):
     '''Custom helper to get package info'''
+    store = cache.request_store('package_info')
+    if pkg_id in store:
+        return store[pkg_id]
     try:
-	 return logic.get_action('package_show')(
+        return logic.get_action('package_show')(
             {}, {'id': pkg_id})
     except (logic.NotFound, logic.ValidationError, logic.NotAuthorized):
         return {}
 
 
+def get_package_formats_many(packages):
+    '''Fetch the resource formats summaries of many packages with one query.
+
+    The results are remembered for the rest of the request, so that the
+    get_package_formats() calls made for each row of a package list don't
+    have to query the database again.
+
+    :param packages: package ids or package dicts
+    :type packages: list
+
+    :returns: a dict mapping package ids to lists of formats
+    :rtype: dict
+
+    '''
+    pkg_ids = [pkg['id'] if isinstance(pkg, dict) else pkg
+               for pkg in packages]
+    store = cache.request_store('package_formats')
+    missing = [pkg_id for pkg_id in pkg_ids if pkg_id not in store]
+    if missing:
+        store.update(db.package_formats(missing))
+        # Packages that haven't been saved or indexed since the plugin was
+        # enabled have no summary yet, get_package_formats() falls back to
+        # their package info for those so fetch it all at once too.
+        without_summary = [pkg_id for pkg_id in missing
+                           if pkg_id not in store]
+        if without_summary:
+            get_package_info_many(without_summary)
+    return dict((pkg_id, store[pkg_id]) for pkg_id in pkg_ids
+                if pkg_id in store)
+
+
+def get_package_formats(pkg_id):
+    '''Return the distinct resource formats of the given package.
+
+    This reads the summary that BirminghamPlugin maintains whenever a package
+    is saved or indexed, so it doesn't need to load the full package dict.
+
+    '''
+    formats = get_package_formats_many([pkg_id])
+    if pkg_id in formats:
+        return formats[pkg_id]
+    resources = get_package_info(pkg_id).get('resources', [])
+    return db.distinct_formats(
+        resource.get('format') for resource in resources)
+
+
+def memo_stats():
+    '''Return the helper memo's hits and misses for the current request.
+
+    Returns None unless debug mode is on.
+
+    '''
+    if not toolkit.asbool(config.get('debug', False)):
+        return None
+    stats = cache.memo_stats()
+    log.debug('Memoized helpers: %(hits)s hits, %(misses)s misses', stats)
+    return stats
+
+
+# The rendered homepage snippets are shared by all requests, they're cleared
+# whenever a group, organization or package changes.
+_fragment_cache = cache.TTLCache(name='fragments')
+
+
+def cached_snippet(template_name, **kwargs):
+    '''Render a snippet, reusing the HTML it rendered to last time.
+
+    The HTML is cached across requests, keyed by the template name, the
+    snippet's arguments and the current locale, for
+    ckanext.birmingham.fragment_cache_ttl seconds or until a group,
+    organization or package changes. Only anonymous users' renders are
+    cached and served from the cache: snippets can show what the current user
+    is allowed to see (e.g. the private datasets of the featured
+    organizations), so logged-in users always get a fresh render. Only use
+    this for snippets that look the same to every anonymous user.
+
+    '''
+    import ckan.lib.helpers as h
+    if _current_user():
+        return h.snippet(template_name, **kwargs)
+    key = (template_name, tuple(sorted(kwargs.items())), h.lang())
+    try:
+        hash(key)
+    except TypeError:
+        return h.snippet(template_name, **kwargs)
+    html = cache.cached(_fragment_cache, key, h.snippet, template_name,
+                        **kwargs)
+    return h.literal(html)
+
+
+def _current_user():
+    try:
+        return getattr(toolkit.c, 'user', None)
+    except TypeError:
+        # No request is registered for this thread.
+        return None
+
+
+# The most used tags, refreshed every ckanext.birmingham.popular_tags_ttl
+# seconds, keyed by limit.
+_popular_tags_cache = cache.TTLCache(maxsize=8, name='popular_tags')
+
+
+def popular_tags(limit=3):
+    '''Return the site's most used tags, most used first.
+
+    The tags come from a single tags facet query whose result is cached
+    across requests for ckanext.birmingham.popular_tags_ttl seconds, so
+    unlike h.get_facet_items_dict('tags') this doesn't depend on the page
+    having run a search.
+
+    :returns: up to limit dicts with each tag's name, display_name and count,
+              the same as h.get_facet_items_dict('tags') returns
+    :rtype: list of dicts
+
+    '''
+    return list(cache.cached(_popular_tags_cache, limit, _popular_tags, limit))
+
+
+def _popular_tags(limit):
+    try:
+        result = logic.get_action('package_search')(
+            {}, {'q': '*:*', 'rows': 0, 'facet.field': ['tags'],
+                 'facet.limit': limit})
+    except (logic.ValidationError, search.SearchError):
+        return []
+    tags = result['search_facets'].get('tags', {}).get('items', [])
+    tags = sorted(tags, key=lambda tag: tag['count'], reverse=True)
+    return tags[:limit]
+
+
+# The packages' notes extracts, keyed by the package's id and
+# metadata_modified, so an edited package gets a new extract. The entries
+# never go stale, the ttl only lets the extracts of packages that are no
+# longer shown be dropped.
+_notes_cache = cache.TTLCache(name='notes')
+NOTES_CACHE_TTL = 24 * 60 * 60
+
+
+def notes_extract(package, extract_length=180):
+    '''Return a plain text extract of a package's notes.
+
+    The same as h.markdown_extract(package.notes, extract_length), but the
+    extract is cached across requests so the notes of packages that are
+    listed often aren't parsed as markdown on every render.
+
+    :param package: a package dict with id, metadata_modified and notes
+    :param extract_length: the extract's maximum length
+
+    '''
+    import ckan.lib.helpers as h
+    notes = package.get('notes')
+    if not notes:
+        return ''
+    key = (package.get('id'), package.get('metadata_modified'),
+           extract_length)
+    if key[0] is None or key[1] is None:
+        return h.markdown_extract(notes, extract_length=extract_length)
+    return h.literal(cache.cached(_notes_cache, key, h.markdown_extract,
+                                  notes, extract_length=extract_length))
+
+
+def _package_from_hook(context, pkg_dict):
+    '''Return the package object that an IPackageController hook is about.'''
+    pkg = context.get('package')
+    if pkg is None:
+        pkg = context['model'].Package.get(
+            pkg_dict.get('id') or pkg_dict.get('name'))
+    return pkg
+
+
+def _warm_editor_count():
+    '''Initialize the editor counter, if up_to_n_editors is maintaining it.'''
+    if _listening_for_editor_changes:
+        editor_count()
+
+
+def _remove_session():
+    import ckan.model
+    ckan.model.Session.remove()
+
+
+# Keeps the featured groups and organizations and the popular tags fresh on a
+# background thread, so requests don't have to wait for them to be rebuilt
+# when they expire. The rendered snippets need a request to be rendered, so
+# they aren't refreshed.
+_refresher = cache.Refresher(
+    caches=[_featured_cache, _popular_tags_cache],
+    warm=[get_featured_org_no_limit, get_featured_groups_no_limit,
+          popular_tags, _warm_editor_count],
+    cleanup=_remove_session)
+atexit.register(_refresher.stop)
+
+
+def metrics_caches():
+    '''Return the caches whose hit ratios the metrics endpoint reports.'''
+    return [(ttl_cache.name, ttl_cache) for ttl_cache in
+            (_featured_cache, _fragment_cache, _popular_tags_cache,
+             _notes_cache)]
+
+
+def _content_changed():
+    '''Empty the caches of anything built from packages, groups or orgs, and
+    bump the content revision that the homepage's ETags are built from.
+
+    The caches are emptied now and again once the change is committed,
+    because a request running in between can put the data from before the
+    commit back into them. The revision is only bumped once the change is
+    committed, in a short transaction of its own, so the change's transaction
+    doesn't hold the counter's row lock (which every other change would wait
+    for) until it commits.
+
+    '''
+    import ckan.model
+    _clear_content_caches()
+    _listen_for_content_changes()
+    ckan.model.Session()._birmingham_content_changed = True
+
+
+def _clear_content_caches():
+    _featured_cache.clear()
+    _fragment_cache.clear()
+
+
+def _listen_for_content_changes():
+    '''Finish _content_changed()'s work when the session's transaction ends.'''
+    global _listening_for_content_changes
+    if _listening_for_content_changes:
+        return
+    sa.event.listen(sa.orm.Session, 'before_flush', _note_config_changes)
+    sa.event.listen(sa.orm.Session, 'after_commit', _after_commit)
+    sa.event.listen(sa.orm.Session, 'after_rollback', _after_rollback)
+    _listening_for_content_changes = True
+
+
+_listening_for_content_changes = False
+
+
+def _note_config_changes(session, flush_context, instances):
+    # The site's config (/ckan-admin/config) is saved as SystemInfo objects,
+    # and the homepage shows some of it, e.g. the site title and intro text.
+    import ckan.model
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, ckan.model.SystemInfo):
+            session._birmingham_content_changed = True
+            return
+
+
+def _after_commit(session):
+    if getattr(session, '_birmingham_content_changed', False):
+        session._birmingham_content_changed = False
+        _clear_content_caches()
+        import ckan.model
+        try:
+            with ckan.model.meta.engine.begin() as connection:
+                middleware.bump_content_revision(connection)
+        except sa.exc.SQLAlchemyError:
+            # The change itself is already committed, so don't fail the
+            # request. Pages keep their old ETags until the next change.
+            log.exception('Could not bump the content revision')
+
+
+def _after_rollback(session):
+    session._birmingham_content_changed = False
+
+
 class UpToNEditorsPlugin(plugins.SingletonPlugin):
     '''A CKAN plugin that limits the site's number of "editors".
 
@@ -173,24 +1141,144 @@ class UpToNEditorsPlugin(plugins.SingletonPlugin):
 
     '''
     plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IActions)
+
+    def configure(self, config):
+        settings.reload(config)
+        db.setup()
+        db.setup_read_replica(settings.read_replica_url)
+        _listen_for_editor_changes()
 
     def get_auth_functions(self):
-        return {'member_create': member_create}
+        return metrics.instrument_all('auth', {
+            'member_create': member_create,
+            'birmingham_member_create_many': member_create_many_auth,
+        })
+
+    def get_actions(self):
+        return {'birmingham_member_create_many': member_create_many}
 
 
 class BirminghamPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IMiddleware, inherit=True)
+    plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IGroupController, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
 
     def update_config(self, config):
         toolkit.add_resource('fanstatic', 'ckanext-birmingham')
-	toolkit.add_public_directory(config, "public")
+        toolkit.add_public_directory(config, "public")
+
+    def configure(self, config):
+        settings.reload(config)
+        db.setup()
+        db.setup_read_replica(settings.read_replica_url)
+        assets.load_manifest()
+        _listen_for_content_changes()
+        # One backend for all the caches, each in its own namespace.
+        backend = cache.backend_from_url(settings.cache_backend)
+        _featured_cache.configure(maxsize=settings.featured_cache_size,
+                                  ttl=settings.featured_cache_ttl,
+                                  backend=backend)
+        _fragment_cache.configure(maxsize=settings.fragment_cache_size,
+                                  ttl=settings.fragment_cache_ttl,
+                                  backend=backend)
+        _popular_tags_cache.configure(maxsize=8, ttl=settings.popular_tags_ttl,
+                                      backend=backend)
+        _notes_cache.configure(maxsize=settings.notes_cache_size,
+                               ttl=NOTES_CACHE_TTL, backend=backend)
+        if settings.background_refresh:
+            _refresher.start(settings.refresh_interval)
+        else:
+            _refresher.stop()
+        if settings.metrics:
+            import ckan.model
+            metrics.listen_for_queries(ckan.model.meta.engine)
+
+    def before_map(self, map_):
+        map_.connect('birmingham_metrics', '/birmingham/metrics',
+                     controller='ckanext.birmingham.controller:'
+                                'MetricsController',
+                     action='metrics')
+        return map_
+
+    def make_middleware(self, app, config):
+        app = middleware.AssetMiddleware(app)
+        return middleware.ConditionalGetMiddleware(app, config)
 
     def get_helpers(self):
-        return {
+        helpers = metrics.instrument_all('helper', cache.memoize_helpers({
             'get_package_info': get_package_info,
-	    'get_featured_org_no_limit': get_featured_org_no_limit,
-	    'get_featured_groups_no_limit': get_featured_groups_no_limit,
-        }
+            'get_package_info_many': get_package_info_many,
+            'get_package_formats': get_package_formats,
+            'get_package_formats_many': get_package_formats_many,
+            'birmingham_cached_snippet': cached_snippet,
+            'birmingham_popular_tags': popular_tags,
+            'get_featured_org_no_limit': get_featured_org_no_limit,
+            'get_featured_groups_no_limit': get_featured_groups_no_limit,
+            'birmingham_asset_url': assets.asset_url,
+            'birmingham_notes_extract': notes_extract,
+        }))
+        # Not memoized, it reports the memo's own hits and misses.
+        helpers['birmingham_memo_stats'] = metrics.instrument(
+            'helper', 'birmingham_memo_stats', memo_stats)
+        return helpers
+
+    def get_actions(self):
+        return {'birmingham_package_info_many': package_info_many}
+
+    # IPackageController hooks that keep the resource formats summaries read
+    # by get_package_formats() up to date.
+
+    def after_create(self, context, pkg_dict):
+        self._save_package_formats(context, pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._save_package_formats(context, pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        pkg = _package_from_hook(context, pkg_dict)
+        if pkg:
+            db.delete_package_formats(pkg.id, session=context['session'])
+
+    def before_index(self, pkg_dict):
+        # This runs while a package's transaction is being committed, after
+        # the hooks above have written its summary in that transaction, and
+        # when the search index is rebuilt, which fills in the summaries of
+        # packages that were created before the plugin was enabled.
+        import ckan.model
+        if db.package_formats_pending(ckan.model.Session, pkg_dict['id']):
+            return pkg_dict
+        db.save_package_formats(
+            pkg_dict['id'],
+            db.distinct_formats(pkg_dict.get('res_format', [])))
+        return pkg_dict
+
+    def _save_package_formats(self, context, pkg_dict):
+        pkg = _package_from_hook(context, pkg_dict)
+        if pkg:
+            db.save_package_formats(pkg.id, db.distinct_formats(
+                resource.format for resource in pkg.resources),
+                session=context['session'])
+
+    # These hooks are shared by IPackageController, IGroupController and
+    # IOrganizationController, so they run whenever a package, group or
+    # organization changes. The featured groups and organizations include
+    # dataset counts, so a package change empties their caches too. They run
+    # before the change is committed, so the rest is done once it is (see
+    # _content_changed()).
+
+    def create(self, entity):
+        _content_changed()
 
+    def edit(self, entity):
+        _content_changed()
 
+    def delete(self, entity):
+        _content_changed()
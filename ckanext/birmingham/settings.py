@@ -0,0 +1,156 @@
+'''The birmingham plugins' config settings, parsed once.'''
+import hashlib
+
+import pylons.config
+
+import ckan.plugins.toolkit as toolkit
+
+
+class Settings(object):
+    '''The birmingham plugins' config settings, parsed and validated.
+
+    The plugins reload the module-level ``settings`` object from their
+    IConfigurable.configure() methods, so helpers and auth functions read
+    already-parsed attributes rather than looking up and parsing the config
+    on every call. Call reload() after changing the config at runtime.
+
+    '''
+    __slots__ = (
+        'max_editors',
+        'featured_orgs',
+        'featured_groups',
+        'featured_orgs_auto',
+        'featured_groups_auto',
+        'featured_caption',
+        'featured_image',
+        'featured_alt_text',
+        'featured_cache_ttl',
+        'featured_cache_size',
+        'fragment_cache_ttl',
+        'fragment_cache_size',
+        'popular_tags_ttl',
+        'notes_cache_size',
+        'background_refresh',
+        'refresh_interval',
+        'cache_backend',
+        'conditional_get',
+        'read_replica_url',
+        'metrics',
+    )
+
+    def __init__(self, config=None):
+        self.load(config or {})
+
+    def load(self, config):
+        '''Parse and validate the settings from the given config dict.
+
+        :raises ValueError: if a setting has an invalid value
+
+        '''
+        self.max_editors = _non_negative_int(
+            config, 'ckan.birmingham.max_editors', 3)
+        self.featured_orgs = tuple(config.get('ckan.featured_orgs', '').split())
+        self.featured_groups = tuple(
+            config.get('ckan.featured_groups', '').split())
+        self.featured_orgs_auto = _choice(
+            config, 'ckan.featured_orgs.auto', FEATURED_AUTO_MODES)
+        self.featured_groups_auto = _choice(
+            config, 'ckan.featured_groups.auto', FEATURED_AUTO_MODES)
+        self.featured_caption = config.get(
+            'ckanext.birmingham.featured_caption',
+            'This is a featured section')
+        self.featured_image = config.get(
+            'ckanext.birmingham.featured_image', 'http://placehold.it/420x220')
+        if not self.featured_image.strip():
+            raise ValueError(
+                'ckanext.birmingham.featured_image must not be empty')
+        self.featured_alt_text = config.get(
+            'ckanext.birmingham.featured_alt_text', 'Placeholder')
+        self.featured_cache_ttl = _non_negative_int(
+            config, 'ckanext.birmingham.featured_cache_ttl', 300)
+        self.featured_cache_size = _non_negative_int(
+            config, 'ckanext.birmingham.featured_cache_size', 32)
+        self.fragment_cache_ttl = _non_negative_int(
+            config, 'ckanext.birmingham.fragment_cache_ttl', 300)
+        self.fragment_cache_size = _non_negative_int(
+            config, 'ckanext.birmingham.fragment_cache_size', 64)
+        self.popular_tags_ttl = _non_negative_int(
+            config, 'ckanext.birmingham.popular_tags_ttl', 600)
+        self.notes_cache_size = _non_negative_int(
+            config, 'ckanext.birmingham.notes_cache_size', 1000)
+        self.background_refresh = _bool(
+            config, 'ckanext.birmingham.background_refresh', True)
+        self.refresh_interval = _non_negative_int(
+            config, 'ckanext.birmingham.refresh_interval', 60)
+        if self.refresh_interval == 0:
+            raise ValueError(
+                'ckanext.birmingham.refresh_interval must be at least 1')
+        self.cache_backend = config.get(
+            'ckanext.birmingham.cache_backend', 'memory').strip()
+        if not (self.cache_backend == 'memory' or
+                self.cache_backend.startswith(CACHE_BACKEND_SCHEMES)):
+            raise ValueError(
+                'ckanext.birmingham.cache_backend must be memory or a URL '
+                'starting with one of {0!r}, not {1!r}'.format(
+                    CACHE_BACKEND_SCHEMES, self.cache_backend))
+        self.conditional_get = _bool(
+            config, 'ckanext.birmingham.conditional_get', True)
+        self.read_replica_url = config.get(
+            'ckanext.birmingham.read_replica_url', '').strip()
+        self.metrics = _bool(config, 'ckanext.birmingham.metrics', False)
+
+    def reload(self, config=None):
+        '''Reload the settings from the given config dict.
+
+        :param config: the config to load (optional, default: the Pylons
+                       config)
+
+        '''
+        self.load(pylons.config if config is None else config)
+
+    def fingerprint(self):
+        '''Return a string that changes whenever any of the settings do.'''
+        values = tuple(getattr(self, name) for name in self.__slots__)
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+# How to fill the featured slots that ckan.featured_orgs and
+# ckan.featured_groups leave empty: alphabetically (''), or with the ones with
+# the most datasets first.
+FEATURED_AUTO_MODES = ('', 'by_dataset_count')
+
+# The kinds of URL that ckanext.birmingham.cache_backend can be, besides
+# memory.
+CACHE_BACKEND_SCHEMES = ('file://', 'redis://', 'rediss://', 'unix://')
+
+
+def _choice(config, key, choices):
+    value = config.get(key, choices[0]).strip()
+    if value not in choices:
+        raise ValueError('{0} must be one of {1!r}, not {2!r}'.format(
+            key, choices, value))
+    return value
+
+
+def _bool(config, key, default):
+    value = config.get(key, default)
+    try:
+        return toolkit.asbool(value)
+    except ValueError:
+        raise ValueError('{0} must be true or false, not {1!r}'.format(
+            key, value))
+
+
+def _non_negative_int(config, key, default):
+    value = config.get(key, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('{0} must be an integer, not {1!r}'.format(
+            key, value))
+    if value < 0:
+        raise ValueError('{0} must not be negative'.format(key))
+    return value
+
+
+settings = Settings()
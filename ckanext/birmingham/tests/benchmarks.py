@@ -0,0 +1,185 @@
+'''Benchmarks for the birmingham plugins' hot helpers and pages.
+
+These aren't run with the tests (nose doesn't collect this module unless it's
+named), to run them:
+
+    nosetests --with-pylons=test.ini ckanext/birmingham/tests/benchmarks.py
+
+Each scale point seeds a fresh database with the factories and times the
+helpers and page renders. The scale points to run are read from the
+BIRMINGHAM_BENCHMARK_SCALES environment variable (default: small), e.g.
+``BIRMINGHAM_BENCHMARK_SCALES="small medium"``. The results are written as
+JSON to BIRMINGHAM_BENCHMARK_OUTPUT (default: birmingham-benchmarks.json),
+to be compared across releases.
+
+'''
+import datetime
+import json
+import os
+import platform
+import timeit
+
+import pkg_resources
+import pylons.config as config
+import webtest
+
+import ckan.plugins.toolkit as toolkit
+import ckan.config.middleware
+import ckan.new_tests.factories as factories
+import ckan.new_tests.helpers as helpers
+
+import ckanext.birmingham.plugin as plugin
+from ckanext.birmingham.settings import settings
+
+
+# The number of each kind of object that each scale point seeds.
+SCALES = {
+    'small': {'organizations': 10, 'groups': 10, 'members': 100,
+              'datasets': 100},
+    'medium': {'organizations': 100, 'groups': 100, 'members': 1000,
+               'datasets': 1000},
+    'large': {'organizations': 1000, 'groups': 1000, 'members': 10000,
+              'datasets': 100000},
+}
+
+# How many times each benchmark is run at each scale point.
+REPEAT = 20
+
+
+def _get_test_app(plugin_names):
+    '''Return a webtest.TestApp for CKAN with the given plugins loaded.'''
+    plugins = set(config['ckan.plugins'].strip().split())
+    plugins.update(plugin_names)
+    config['ckan.plugins'] = ' '.join(plugins)
+    config['ckan.legacy_templates'] = False
+    app = ckan.config.middleware.make_app(config['global_conf'], **config)
+    return webtest.TestApp(app)
+
+
+def _time(func, repeat=REPEAT, setup=None):
+    '''Call func repeat times and return its timings, in milliseconds.
+
+    :param setup: a function to call before each call of func, not timed
+                  (optional)
+
+    '''
+    timings = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        timings.append((timeit.default_timer() - start) * 1000)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'min_ms': timings[0],
+        'median_ms': timings[len(timings) // 2],
+        'mean_ms': sum(timings) / len(timings),
+        'max_ms': timings[-1],
+    }
+
+
+def _seed(sizes):
+    '''Create the objects for a scale point and return some of them.'''
+    sysadmin = factories.Sysadmin()
+    admin = factories.User()
+    organizations = [factories.Organization(user=admin)
+                     for i in range(sizes['organizations'])]
+    groups = [factories.Group(user=sysadmin) for i in range(sizes['groups'])]
+
+    context = {'user': sysadmin['name']}
+    for i in range(sizes['members']):
+        user = factories.User()
+        helpers.call_action(
+            'member_create', context=dict(context),
+            id=organizations[i % len(organizations)]['id'],
+            object=user['id'], object_type='user', capacity='editor')
+
+    datasets = []
+    for i in range(sizes['datasets']):
+        datasets.append(factories.Dataset(
+            owner_org=organizations[i % len(organizations)]['id'],
+            groups=[{'name': groups[i % len(groups)]['name']}],
+            resources=[{'url': 'http://example.com/{0}.csv'.format(i),
+                        'format': 'CSV'}]))
+
+    return {'admin': admin, 'organizations': organizations,
+            'datasets': datasets, 'new_user': factories.User()}
+
+
+def _benchmark(app, seeded):
+    '''Time each of the helpers and pages, and return the timings.'''
+    organization = seeded['organizations'][0]
+    dataset = seeded['datasets'][0]
+    member_create_data_dict = {'id': organization['id'],
+                               'object': seeded['new_user']['id'],
+                               'object_type': 'user', 'capacity': 'editor'}
+
+    def member_create():
+        try:
+            toolkit.check_access('member_create',
+                                 {'user': seeded['admin']['name']},
+                                 dict(member_create_data_dict))
+        except toolkit.NotAuthorized:
+            pass
+
+    def featured_organizations():
+        plugin.featured_group_org_no_limit(
+            items=[], is_organization=True,
+            list_action='organization_list', count=4)
+
+    return {
+        'editors_and_admins': _time(plugin.editors_and_admins),
+        'member_create': _time(member_create),
+        'featured_group_org_no_limit_cold': _time(
+            featured_organizations, setup=plugin._featured_cache.clear),
+        'featured_group_org_no_limit_warm': _time(featured_organizations),
+        'get_package_info': _time(
+            lambda: plugin.get_package_info(dataset['id'])),
+        'homepage': _time(lambda: app.get('/')),
+        'search_page': _time(lambda: app.get('/dataset')),
+    }
+
+
+class TestBenchmarks(object):
+
+    '''Times the helpers and pages at each scale point.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        cls.app = _get_test_app(['birmingham', 'up_to_n_editors',
+                                 'customizable_featured_image'])
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+        settings.reload()
+
+    def test_benchmarks(self):
+        scales = os.environ.get('BIRMINGHAM_BENCHMARK_SCALES',
+                                'small').split()
+        results = []
+        for scale in scales:
+            sizes = SCALES[scale]
+            helpers.reset_db()
+            # Let every seeded member be an editor.
+            config['ckan.birmingham.max_editors'] = str(
+                sizes['members'] + 10)
+            settings.reload()
+            seeded = _seed(sizes)
+            results.append({'scale': scale, 'sizes': sizes,
+                            'benchmarks': _benchmark(self.app, seeded)})
+
+        output = os.environ.get('BIRMINGHAM_BENCHMARK_OUTPUT',
+                                'birmingham-benchmarks.json')
+        with open(output, 'w') as file_:
+            json.dump({
+                'version': pkg_resources.get_distribution(
+                    'ckanext-birmingham').version,
+                'date': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'results': results,
+            }, file_, indent=2, sort_keys=True)
@@ -1,8 +1,16 @@
 '''Tests for plugin.py.'''
 import collections
+import contextlib
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import threading
 
 import mock
 import pylons.config as config
+import sqlalchemy as sa
 import webtest
 import nose.tools
 
@@ -11,7 +19,15 @@ import ckan.config.middleware
 import ckan.new_tests.factories as factories
 import ckan.new_tests.helpers as helpers
 
+import ckanext.birmingham.assets as assets
+import ckanext.birmingham.cache as cache
+import ckanext.birmingham.customizable_featured_image as featured
+import ckanext.birmingham.db as db
+import ckanext.birmingham.images as images
+import ckanext.birmingham.metrics as metrics
+import ckanext.birmingham.middleware as middleware
 import ckanext.birmingham.plugin as plugin
+from ckanext.birmingham.settings import Settings, settings
 
 
 def _equal_unordered(list_1, list_2):
@@ -24,6 +40,46 @@ def _equal_unordered(list_1, list_2):
     return collections.Counter(list_1) == collections.Counter(list_2)
 
 
+class _QueryCount(object):
+    def __init__(self):
+        self.count = 0
+
+
+# The _QueryCounts of the active count_queries() blocks.
+_query_counts = []
+
+
+def _count_query(*args, **kwargs):
+    for query_count in _query_counts:
+        query_count.count += 1
+
+
+@contextlib.contextmanager
+def count_queries():
+    '''Count the SQL statements run in the with block.
+
+    Usage::
+
+        with count_queries() as queries:
+            ...
+        assert queries.count == 3
+
+    '''
+    import ckan.model as model
+    if not getattr(count_queries, 'listening', False):
+        # Older SQLAlchemys can't remove listeners, so listen once and only
+        # count while there are count_queries() blocks.
+        sa.event.listen(model.meta.engine, 'before_cursor_execute',
+                        _count_query)
+        count_queries.listening = True
+    query_count = _QueryCount()
+    _query_counts.append(query_count)
+    try:
+        yield query_count
+    finally:
+        _query_counts.remove(query_count)
+
+
 class TestEditorsAndAdmins(object):
 
     '''Functional tests for the editors_and_admins() function.'''
@@ -80,6 +136,148 @@ class TestEditorsAndAdmins(object):
                                 [admin_1['id'], admin_2['id'], editor['id']])
 
 
+class TestCountEditorsAndSysadmins(object):
+
+    '''Functional tests for the count_editors_and_sysadmins() function.'''
+
+    def setup(self):
+        helpers.reset_db()
+
+    def test_with_0_editors_or_sysadmins(self):
+        assert plugin.count_editors_and_sysadmins() == 0
+
+    def test_with_editors_admins_and_sysadmins(self):
+        admin = factories.User()
+        org = factories.Organization(user=admin)
+        editor = factories.User()
+        helpers.call_action('organization_member_create',
+                            context={'user': admin['name']},
+                            id=org['id'], username=editor['name'],
+                            role='editor')
+        factories.User()
+        factories.Sysadmin()
+
+        assert plugin.count_editors_and_sysadmins() == 3
+
+    def test_counts_each_user_once(self):
+        '''A sysadmin who is also the admin of a group and an organization
+        should only be counted once.
+
+        '''
+        sysadmin = factories.Sysadmin()
+        factories.Organization(user=sysadmin)
+        factories.Group(user=sysadmin)
+
+        assert plugin.count_editors_and_sysadmins() == 1
+
+
+class TestEditorCount(object):
+
+    '''Functional tests for the maintained editor counter.'''
+
+    def setup(self):
+        helpers.reset_db()
+        plugin._listen_for_editor_changes()
+
+    def _assert_counter_is_right(self):
+        assert plugin.editor_count() == plugin.count_editors_and_sysadmins()
+
+    def test_counter_is_initialized_when_first_read(self):
+        factories.Sysadmin()
+
+        assert plugin.editor_count() == 1
+
+    def test_counter_follows_membership_changes(self):
+        plugin.reconcile_editor_count()
+        admin = factories.User()
+        org = factories.Organization(user=admin)
+        self._assert_counter_is_right()
+
+        editor = factories.User()
+        helpers.call_action('organization_member_create',
+                            context={'user': admin['name']},
+                            id=org['id'], username=editor['name'],
+                            role='editor')
+        assert plugin.editor_count() == 2
+        self._assert_counter_is_right()
+
+        # Making an existing editor an editor of another org doesn't add an
+        # editor.
+        org_2 = factories.Organization(user=admin)
+        helpers.call_action('organization_member_create',
+                            context={'user': admin['name']},
+                            id=org_2['id'], username=editor['name'],
+                            role='editor')
+        assert plugin.editor_count() == 2
+
+        helpers.call_action('organization_member_create',
+                            context={'user': admin['name']},
+                            id=org['id'], username=editor['name'],
+                            role='member')
+        helpers.call_action('organization_member_create',
+                            context={'user': admin['name']},
+                            id=org_2['id'], username=editor['name'],
+                            role='member')
+        assert plugin.editor_count() == 1
+        self._assert_counter_is_right()
+
+    def test_counter_follows_sysadmin_changes(self):
+        plugin.reconcile_editor_count()
+        factories.Sysadmin()
+        factories.User()
+        self._assert_counter_is_right()
+
+    def test_snapshot_left_by_a_failed_flush_is_not_used(self):
+        import ckan.model as model
+        session = model.Session()
+        # What a flush that raised before after_flush() would leave behind.
+        stale = ([], set(['stale-editor']))
+
+        session._birmingham_editors_before = stale
+        plugin._before_flush(session, None, None)
+        assert session._birmingham_editors_before is None
+
+        session._birmingham_editors_before = stale
+        model.Session.rollback()
+        assert session._birmingham_editors_before is None
+
+    def test_reconcile_rebuilds_the_counter(self):
+        import ckan.model as model
+        factories.Sysadmin()
+        plugin.reconcile_editor_count()
+        db.set_counter(model.Session, plugin.EDITOR_COUNTER, 42)
+        model.Session.commit()
+
+        assert plugin.reconcile_editor_count() == 1
+        assert plugin.editor_count() == 1
+
+    def test_reconcile_waits_for_the_editor_cap_lock(self):
+        with mock.patch.object(plugin, '_lock_editor_cap') as lock:
+            plugin.reconcile_editor_count()
+
+        assert lock.call_count == 1
+
+    def test_set_counter_survives_a_concurrent_first_insert(self):
+        import ckan.model as model
+        db.get_or_create_counter('test', initial=1)
+
+        with model.meta.engine.begin() as connection:
+            execute = connection.execute
+            # The first update runs before the other process's insert.
+            results = [mock.Mock(rowcount=0)]
+
+            def execute_after_insert(statement, *args, **kwargs):
+                if results:
+                    return results.pop()
+                return execute(statement, *args, **kwargs)
+
+            with mock.patch.object(connection, 'execute',
+                                   side_effect=execute_after_insert):
+                db.set_counter(connection, 'test', 5)
+
+        assert db.get_counter(model.Session, 'test') == 5
+
+
 class TestSysadmins:
     '''Functional tests for the sysadmins function.'''
 
@@ -107,6 +305,55 @@ class TestSysadmins:
             [sysadmin_1['id'], sysadmin_2['id'], sysadmin_3['id']])
 
 
+class TestReadReplica(object):
+
+    '''Tests for sending the read-only queries to a read replica.
+
+    The test database stands in for the replica, set
+    ckanext.birmingham.test_read_replica_url to use a second database that
+    replicates it instead.
+
+    '''
+
+    def setup(self):
+        helpers.reset_db()
+        db.setup_read_replica(config.get(
+            'ckanext.birmingham.test_read_replica_url',
+            config['sqlalchemy.url']))
+
+    def teardown(self):
+        db.setup_read_replica('')
+
+    def test_read_session_is_not_the_primary_session(self):
+        import ckan.model as model
+        with db.read_session() as session:
+            assert session is not model.Session
+            assert session.bind is db._read_engine
+
+    def test_sysadmins_and_editors_are_read_from_the_replica(self):
+        sysadmin = factories.Sysadmin()
+        user = factories.User()
+        factories.Organization(user=user)
+
+        assert plugin.sysadmins() == [sysadmin['id']]
+        assert plugin.editors_and_admins() == [user['id']]
+
+    def test_group_summaries_are_read_from_the_replica(self):
+        group = factories.Group()
+
+        summaries = plugin.group_summaries([group['name']],
+                                           is_organization=False)
+
+        assert summaries[group['id']]['name'] == group['name']
+
+    def test_no_replica_means_the_primary_session(self):
+        import ckan.model as model
+        db.setup_read_replica('')
+
+        with db.read_session() as session:
+            assert session is model.Session
+
+
 def _editor_create_data_dict():
     '''Return a data_dict similar to what would be passed to the
     member_create() action function to create a new editor.
@@ -118,192 +365,195 @@ def _editor_create_data_dict():
             'capacity': 'editor'}
 
 
+def _count(sysadmins, editors_and_admins):
+    '''Return what editor_count() would return for the given sysadmins and
+    group/org editors and admins.
+
+    '''
+    return len(set(sysadmins + editors_and_admins))
+
+
 class TestMemberCreate:
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_no_editors(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_no_editors(self, count_editors):
         '''If there are no editors, admins or sysadmins and max_editors > 0
         then member_create should allow creating a new editor.
 
         '''
-        sysadmins.return_value = []
-        editors_and_admins.return_value = []
+        count_editors.return_value = _count(
+            sysadmins=[],
+            editors_and_admins=[])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=3)
 
         assert result['success'] is True
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_1_editor_and_1_admin(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_1_editor_and_1_admin(self, count_editors):
         '''If there are less than max_editors editors/admins/sysadmins then
         member_create should allow creating a new editor.
 
         '''
-        sysadmins.return_value = ['sysadmin']
-        editors_and_admins.return_value = ['editor']
+        count_editors.return_value = _count(
+            sysadmins=['sysadmin'],
+            editors_and_admins=['editor'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=3)
 
         assert result['success'] is True
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_2_editors_and_1_sysadmin(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_2_editors_and_1_sysadmin(self, count_editors):
         '''If the number of editors/admins/sysadmins is equal to max_editors,
         then member_create should not allow a new editor to be created.
 
         '''
-        sysadmins.return_value = ['sysadmin']
-        editors_and_admins.return_value = ['editor_1', 'editor_2']
+        count_editors.return_value = _count(
+            sysadmins=['sysadmin'],
+            editors_and_admins=['editor_1', 'editor_2'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=3)
 
         assert result['success'] is False
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_2_editors_and_2_sysadmins(self, sysadmins,
-                                            editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_2_editors_and_2_sysadmins(self, count_editors):
         '''If the number of editors/admins/sysadmins is greater than
         max_editors then member_create should not allow a new editor to be
         created.
 
         '''
-        sysadmins.return_value = ['sysadmin_1', 'sysadmin_2']
-        editors_and_admins.return_value = ['editor_1', 'editor_2']
+        count_editors.return_value = _count(
+            sysadmins=['sysadmin_1', 'sysadmin_2'],
+            editors_and_admins=['editor_1', 'editor_2'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=3)
 
         assert result['success'] is False
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_max_editors_0(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_max_editors_0(self, count_editors):
         '''If max_editors is 0 and there are no editors/admins/sysadmins you
         still shouldn't be allowed to create a new editor.
 
         '''
-        sysadmins.return_value = []
-        editors_and_admins.return_value = []
+        count_editors.return_value = _count(
+            sysadmins=[],
+            editors_and_admins=[])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=0)
 
         assert result['success'] is False
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_4_editors_and_max_editors_5(self, sysadmins,
-                                              editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_4_editors_and_max_editors_5(self, count_editors):
         '''If max_editors is 5 and there are less than 5
         editors/admins/sysadmins then you should be able to create a new
         editor.
 
         '''
-        sysadmins.return_value = ['sysadmin_1', 'sysadmin_2']
-        editors_and_admins.return_value = ['editor', 'admin']
+        count_editors.return_value = _count(
+            sysadmins=['sysadmin_1', 'sysadmin_2'],
+            editors_and_admins=['editor', 'admin'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=5)
 
         assert result['success'] is True
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_5_editors_and_max_editors_5(self, sysadmins,
-                                              editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_5_editors_and_max_editors_5(self, count_editors):
         '''If max_editors is 5 and there are 5 editors/admins/sysadmins
         then you shouldn't be able to create another editor.
 
         '''
-        sysadmins.return_value = ['sysadmin_1', 'sysadmin_2', 'sysadmin_3']
-        editors_and_admins.return_value = ['editor', 'admin']
+        count_editors.return_value = _count(
+            sysadmins=['sysadmin_1', 'sysadmin_2', 'sysadmin_3'],
+            editors_and_admins=['editor', 'admin'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=5)
 
         assert result['success'] is False
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_with_6_editors_and_max_editors_5(self, sysadmins,
-                                              editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_with_6_editors_and_max_editors_5(self, count_editors):
         '''If max_editors is 5 and there are more than 5
         editors/admins/sysadmins then you shouldn't be able to create another
         editor.
 
         '''
-        sysadmins.return_value = ['sysadmin_1', 'sysadmin_2', 'sysadmin_3']
-        editors_and_admins.return_value = ['editor', 'admin', 'editor_2']
+        count_editors.return_value = _count(
+            sysadmins=['sysadmin_1', 'sysadmin_2', 'sysadmin_3'],
+            editors_and_admins=['editor', 'admin', 'editor_2'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=5)
 
         assert result['success'] is False
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_does_not_double_count(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_does_not_double_count(self, count_editors):
         '''If the same user is both an editor/admin and a sysadmin, they
         should not be counted twice towards max_editors.
 
         '''
-        sysadmins.return_value = ['user_1', 'user_2']
-        editors_and_admins.return_value = ['user_1']
+        count_editors.return_value = _count(
+            sysadmins=['user_1', 'user_2'],
+            editors_and_admins=['user_1'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=3)
 
         assert result['success'] is True
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_does_count_duplicates_once(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_does_count_duplicates_once(self, count_editors):
         '''If the same user is both an editor/admin and a sysadmin, they
         *should* be counted once towards max_editors.
 
         '''
-        sysadmins.return_value = ['user_1', 'user_2', 'user_3']
-        editors_and_admins.return_value = ['user_1']
+        count_editors.return_value = _count(
+            sysadmins=['user_1', 'user_2', 'user_3'],
+            editors_and_admins=['user_1'])
 
         result = plugin._member_create(_editor_create_data_dict(),
                                        {'success': True}, max_editors=3)
 
         assert result['success'] is False
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_returns_False_when_core_returns_False(self, sysadmins,
-                                                   editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_returns_False_when_core_returns_False(self, count_editors):
         '''If the result from the core member_create auth function has
         'success': False then the custom auth function should return that
         result, even if it would otherwise have returned 'success': True.
 
         '''
-        sysadmins.return_value = ['user_1']
-        editors_and_admins.return_value = ['user_1']
+        count_editors.return_value = _count(
+            sysadmins=['user_1'],
+            editors_and_admins=['user_1'])
         core_result = {'success': False, 'msg': 'CKAN core says no'}
         result = plugin._member_create(_editor_create_data_dict(),
                                        core_result, max_editors=3)
 
         assert result == core_result
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_can_still_create_members(self, sysadmins, editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_can_still_create_members(self, count_editors):
         '''It should still be possible to create (non-editor) group/org
         members, even when the number of editors/admins/sysadmins is equal to
         max_editors.
 
         '''
-        sysadmins.return_value = ['user_1', 'user_2']
-        editors_and_admins.return_value = ['user_3']
+        count_editors.return_value = _count(
+            sysadmins=['user_1', 'user_2'],
+            editors_and_admins=['user_3'])
 
         # A data_dict similar to what would be passed to the member_create
         # action function to create a normal (non-editor) member.
@@ -317,10 +567,8 @@ class TestMemberCreate:
 
         assert result['success'] is True
 
-    @mock.patch('ckanext.birmingham.plugin.editors_and_admins')
-    @mock.patch('ckanext.birmingham.plugin.sysadmins')
-    def test_cannot_create_too_many_admins(self, sysadmins,
-                                           editors_and_admins):
+    @mock.patch('ckanext.birmingham.plugin.editor_count')
+    def test_cannot_create_too_many_admins(self, count_editors):
         '''If there are already max_editors editors/admins/sysadmins, it should
         not be possible to create another group/org admin.
 
@@ -328,8 +576,9 @@ class TestMemberCreate:
         one test that creating admins is also blocked.
 
         '''
-        sysadmins.return_value = ['user_1', 'user_2']
-        editors_and_admins.return_value = ['user_3']
+        count_editors.return_value = _count(
+            sysadmins=['user_1', 'user_2'],
+            editors_and_admins=['user_3'])
 
         # A data_dict similar to what would be passed to the member_create
         # action function to create a group or organization admin.
@@ -386,6 +635,7 @@ class TestUpToNEditorsPlugin(object):
         # changed any config settings.
         config.clear()
         config.update(cls.original_config)
+        settings.reload()
 
     def test_organization_member_create_successful(self):
         '''Test creating a new editor when it should succeed.'''
@@ -447,6 +697,7 @@ class TestUpToNEditorsPlugin(object):
 
         '''
         config['ckan.birmingham.max_editors'] = '5'
+        settings.reload()
         organization_admin = factories.User()
         organization = factories.Organization(user=organization_admin)
         editor_1 = factories.User()
@@ -569,3 +820,1633 @@ class TestUpToNEditorsPlugin(object):
         assert response.json['error']['message'] == ("Access denied: You're "
                                                      "only allowed to have 3 "
                                                      "editors")
+
+
+class TestGetPackageInfoMany(object):
+
+    '''Tests for the get_package_info_many() and get_package_info() helpers.'''
+
+    @mock.patch('ckanext.birmingham.cache.request_store')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_fetches_all_packages_with_one_call(self, get_action,
+                                                 request_store):
+        request_store.return_value = {}
+        get_action.return_value.return_value = {
+            'pkg_1': {'id': 'pkg_1'}, 'pkg_2': {'id': 'pkg_2'}}
+
+        result = plugin.get_package_info_many(
+            [{'id': 'pkg_1'}, 'pkg_2', 'pkg_3'])
+
+        get_action.assert_called_once_with('birmingham_package_info_many')
+        assert result == {'pkg_1': {'id': 'pkg_1'}, 'pkg_2': {'id': 'pkg_2'}}
+
+    @mock.patch('ckanext.birmingham.cache.request_store')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_get_package_info_reads_prefetched_packages(self, get_action,
+                                                         request_store):
+        '''get_package_info() shouldn't call package_show for a package that
+        get_package_info_many() has already fetched during this request.
+
+        '''
+        request_store.return_value = {}
+        get_action.return_value.return_value = {'pkg_1': {'id': 'pkg_1'}}
+        plugin.get_package_info_many(['pkg_1'])
+        get_action.reset_mock()
+
+        assert plugin.get_package_info('pkg_1') == {'id': 'pkg_1'}
+        assert not get_action.called
+
+    @mock.patch('ckanext.birmingham.cache.request_store')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_does_not_refetch_prefetched_packages(self, get_action,
+                                                  request_store):
+        request_store.return_value = {}
+        get_action.return_value.return_value = {'pkg_1': {'id': 'pkg_1'}}
+        plugin.get_package_info_many(['pkg_1'])
+        get_action.reset_mock()
+
+        plugin.get_package_info_many(['pkg_1'])
+
+        assert not get_action.called
+
+
+class TestPackageInfoMany(object):
+
+    '''Tests for the birmingham_package_info_many action's validation.'''
+
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_ids_are_searched_for_with_one_query(self, get_action):
+        get_action.return_value.return_value = {'results': [{'id': 'pkg_1'}]}
+
+        result = plugin.package_info_many({}, {'ids': ['pkg_1', 'pkg-2']})
+
+        assert result == {'pkg_1': {'id': 'pkg_1'}}
+        data_dict = get_action.return_value.call_args[0][1]
+        assert data_dict['rows'] == 2
+
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_solr_syntax_in_ids_is_refused(self, get_action):
+        nose.tools.assert_raises(
+            toolkit.ValidationError, plugin.package_info_many, {},
+            {'ids': ['pkg_1") OR (private:true']})
+        assert not get_action.called
+
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_ids_that_are_not_strings_are_refused(self, get_action):
+        nose.tools.assert_raises(
+            toolkit.ValidationError, plugin.package_info_many, {},
+            {'ids': [{'id': 'pkg_1'}]})
+        assert not get_action.called
+
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_too_many_ids_are_refused(self, get_action):
+        ids = ['pkg_{0}'.format(i) for i in range(1001)]
+
+        nose.tools.assert_raises(
+            toolkit.ValidationError, plugin.package_info_many, {},
+            {'ids': ids})
+        assert not get_action.called
+
+
+class TestMemoize(object):
+
+    '''Tests for the request-scoped helper memo.'''
+
+    def test_request_store_outside_of_a_request(self):
+        '''Outside of a request nothing should be remembered.'''
+        cache.request_store('test')['key'] = 'value'
+
+        assert cache.request_store('test') == {}
+
+    @mock.patch('ckanext.birmingham.cache.request_store')
+    def test_helper_is_evaluated_once_per_arguments(self, request_store):
+        stores = collections.defaultdict(dict)
+        request_store.side_effect = lambda name: stores[name]
+        helper = mock.Mock(__name__='helper', side_effect=lambda n=0: n * 2)
+        memoized = cache.memoize('helper', helper)
+
+        assert memoized(n=1) == 2
+        assert memoized(n=1) == 2
+        assert memoized(n=2) == 4
+
+        assert helper.call_count == 2
+        assert cache.memo_stats() == {'hits': 1, 'misses': 2}
+
+    @mock.patch('ckanext.birmingham.cache.request_store')
+    def test_unhashable_arguments_are_not_memoized(self, request_store):
+        stores = collections.defaultdict(dict)
+        request_store.side_effect = lambda name: stores[name]
+        helper = mock.Mock(__name__='helper', return_value='result')
+        memoized = cache.memoize('helper', helper)
+
+        memoized(['pkg_1'])
+        memoized(['pkg_1'])
+
+        assert helper.call_count == 2
+        assert cache.memo_stats() == {'hits': 0, 'misses': 0}
+
+
+class TestDistinctFormats(object):
+
+    '''Tests for the db.distinct_formats() function.'''
+
+    def test_removes_duplicates_and_empty_formats(self):
+        assert db.distinct_formats(['CSV', '', 'JSON', None, 'CSV']) == [
+            'CSV', 'JSON']
+
+
+class TestPackageFormats(object):
+
+    '''Functional tests for the resource formats summaries.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        _load_plugin('birmingham')
+        cls.app = _get_test_app()
+
+    def setup(self):
+        import ckan.model as model
+        model.Session.close_all()
+        model.repo.rebuild_db()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+
+    def test_summary_is_saved_when_a_package_is_created(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'http://example.com/1', 'format': 'CSV'},
+            {'url': 'http://example.com/2', 'format': 'JSON'},
+            {'url': 'http://example.com/3', 'format': 'CSV'}])
+
+        assert db.package_formats([dataset['id']]) == {
+            dataset['id']: ['CSV', 'JSON']}
+
+    def test_summary_is_updated_when_a_resource_is_added(self):
+        dataset = factories.Dataset()
+        helpers.call_action('resource_create', package_id=dataset['id'],
+                            url='http://example.com/1', format='XLS')
+
+        assert plugin.get_package_formats(dataset['id']) == ['XLS']
+
+    def test_summary_is_deleted_when_a_package_is_deleted(self):
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset()
+        helpers.call_action('package_delete',
+                            context={'user': sysadmin['name']},
+                            id=dataset['id'])
+
+        assert db.package_formats([dataset['id']]) == {}
+
+    def test_summary_is_rolled_back_with_the_package(self):
+        import ckan.model as model
+        dataset = factories.Dataset(resources=[
+            {'url': 'http://example.com/1', 'format': 'CSV'}])
+        db.delete_package_formats(dataset['id'])
+
+        plugin.BirminghamPlugin().after_update(
+            {'model': model, 'session': model.Session}, {'id': dataset['id']})
+        assert db.package_formats_pending(model.Session, dataset['id'])
+        model.Session.rollback()
+
+        assert db.package_formats([dataset['id']]) == {}
+        assert not db.package_formats_pending(model.Session, dataset['id'])
+
+
+class TestTTLCache(object):
+
+    '''Tests for the cross-request TTLCache.'''
+
+    def teardown(self):
+        plugin._featured_cache.clear()
+
+    def test_get_and_set(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.set('key', 'value')
+
+        assert ttl_cache.get('key') == 'value'
+        assert ttl_cache.get('missing', 'default') == 'default'
+
+    @mock.patch('ckanext.birmingham.cache.time.time')
+    def test_entries_expire_after_ttl(self, time_):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        time_.return_value = 1000
+        ttl_cache.set('key', 'value')
+
+        time_.return_value = 1059
+        assert ttl_cache.get('key') == 'value'
+        time_.return_value = 1060
+        assert ttl_cache.get('key') is None
+
+    def test_least_recently_used_entry_is_evicted(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+        ttl_cache.get('a')
+        ttl_cache.set('c', 3)
+
+        assert ttl_cache.get('a') == 1
+        assert ttl_cache.get('b') is None
+        assert ttl_cache.get('c') == 3
+
+    def test_size_0_turns_the_cache_off(self):
+        ttl_cache = cache.TTLCache(maxsize=0, ttl=60)
+        ttl_cache.set('key', 'value')
+
+        assert ttl_cache.get('key') is None
+
+    @mock.patch('ckanext.birmingham.plugin._featured_group_org_no_limit')
+    def test_featured_groups_are_cached_until_a_group_changes(
+            self, featured_group_org_no_limit):
+        featured_group_org_no_limit.return_value = [{'id': 'group_1'}]
+        plugin._featured_cache.configure(maxsize=32, ttl=60)
+        birmingham = plugin.BirminghamPlugin()
+
+        for i in range(3):
+            plugin.get_featured_groups_no_limit(count=1)
+        assert featured_group_org_no_limit.call_count == 1
+
+        birmingham.edit(mock.Mock())
+        plugin.get_featured_groups_no_limit(count=1)
+        assert featured_group_org_no_limit.call_count == 2
+
+    @mock.patch('ckanext.birmingham.plugin._featured_group_org_no_limit')
+    def test_featured_groups_are_emptied_again_when_the_change_is_committed(
+            self, featured_group_org_no_limit):
+        import ckan.model as model
+        featured_group_org_no_limit.return_value = [{'id': 'group_1'}]
+        plugin._featured_cache.configure(maxsize=32, ttl=60)
+
+        plugin.BirminghamPlugin().edit(mock.Mock())
+        # A request running before the commit caches the old groups.
+        plugin.get_featured_groups_no_limit(count=1)
+        model.Session.commit()
+        plugin.get_featured_groups_no_limit(count=1)
+
+        assert featured_group_org_no_limit.call_count == 2
+
+
+class _FakeRedis(object):
+
+    '''A stand-in for a Redis client, with just what RedisBackend uses.'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+
+class TestCacheBackends(object):
+
+    '''Tests for the TTLCache backends that are shared between processes.'''
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _shared_caches(self, make_backend):
+        # Two caches with their own backend objects, as two processes would
+        # have.
+        return [cache.TTLCache(maxsize=2, ttl=60, name='featured',
+                               backend=make_backend())
+                for i in range(2)]
+
+    def _assert_shared(self, make_backend):
+        cache_1, cache_2 = self._shared_caches(make_backend)
+        cache_1.set('key', {'id': 'group_1'})
+
+        assert cache_2.get('key') == {'id': 'group_1'}
+
+        cache_2.clear()
+
+        assert cache_1.get('key') is None
+
+    def test_file_backend_is_shared(self):
+        self._assert_shared(lambda: cache.FileBackend(self.directory))
+
+    def test_redis_backend_is_shared(self):
+        client = _FakeRedis()
+        self._assert_shared(lambda: cache.RedisBackend(client))
+
+    def test_file_backend_keeps_maxsize_entries(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60,
+                                   backend=cache.FileBackend(self.directory))
+        for key in ('a', 'b', 'c'):
+            ttl_cache.set(key, key)
+
+        assert len([key for key in ('a', 'b', 'c')
+                    if ttl_cache.get(key) is not None]) == 2
+
+    def test_clear_stops_an_older_generation_from_being_set(self):
+        cache_1, cache_2 = self._shared_caches(
+            lambda: cache.FileBackend(self.directory))
+        generation = cache_1.generation()
+        cache_2.clear()
+
+        cache_1.set('key', 'old', generation=generation)
+
+        assert cache_2.get('key') is None
+
+    def test_backend_from_url(self):
+        assert isinstance(cache.backend_from_url('memory'),
+                          cache.MemoryBackend)
+        file_backend = cache.backend_from_url('file://' + self.directory)
+        assert isinstance(file_backend, cache.FileBackend)
+        assert file_backend.directory == self.directory
+        nose.tools.assert_raises(ValueError, cache.backend_from_url,
+                                 'memcached://localhost')
+
+
+class TestGroupSummaries(object):
+
+    '''Functional tests for group_summaries() and the featured helpers.'''
+
+    def setup(self):
+        helpers.reset_db()
+        plugin._featured_cache.clear()
+
+    def test_finds_groups_by_id_and_by_name(self):
+        org_1 = factories.Organization(title='Org 1',
+                                       description='The first org')
+        org_2 = factories.Organization()
+
+        summaries = plugin.group_summaries([org_1['name'], org_2['id']],
+                                           is_organization=True)
+
+        summary = summaries[org_1['name']]
+        assert summary is summaries[org_1['id']]
+        assert summary['title'] == 'Org 1'
+        assert summary['display_name'] == 'Org 1'
+        assert summary['description'] == 'The first org'
+        assert summary['package_count'] == 0
+        assert summaries[org_2['name']]['id'] == org_2['id']
+
+    def test_does_not_mix_groups_and_organizations(self):
+        group = factories.Group()
+        org = factories.Organization()
+
+        summaries = plugin.group_summaries([group['name'], org['name']],
+                                           is_organization=False)
+
+        assert group['name'] in summaries
+        assert org['name'] not in summaries
+
+    def test_configured_organizations_come_first_without_duplicates(self):
+        org_a = factories.Organization(name='org-a')
+        org_b = factories.Organization(name='org-b')
+        org_c = factories.Organization(name='org-c')
+
+        orgs = plugin.featured_group_org_no_limit(
+            items=['org-c', org_c['id'], 'no-such-org'], is_organization=True,
+            list_action='organization_list', count=3)
+
+        assert [org['name'] for org in orgs] == ['org-c', 'org-a', 'org-b']
+
+
+def _fake_group_summaries(ids_or_names, is_organization):
+    '''A fake group_summaries() where group "id_<name>" is called <name>.'''
+    summaries = {}
+    for id_or_name in ids_or_names:
+        name = id_or_name.replace('id_', '', 1)
+        summaries[id_or_name] = {'id': 'id_' + name, 'name': name}
+    return summaries
+
+
+class TestFeaturedGroupOrgPipeline(object):
+
+    '''Tests for how _featured_group_org_no_limit() finds its candidates.'''
+
+    @mock.patch('ckanext.birmingham.plugin.group_summaries')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_does_not_list_groups_when_configured_items_fill_count(
+            self, get_action, group_summaries):
+        group_summaries.side_effect = _fake_group_summaries
+
+        groups = plugin._featured_group_org_no_limit(
+            ['a', 'b'], is_organization=False, list_action='group_list',
+            count=2)
+
+        assert [group['name'] for group in groups] == ['a', 'b']
+        assert not get_action.called
+
+    @mock.patch('ckanext.birmingham.plugin.group_summaries')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_pages_through_list_action_until_count_is_reached(
+            self, get_action, group_summaries):
+        group_summaries.side_effect = _fake_group_summaries
+        all_groups = ['g{0}'.format(i) for i in range(100)]
+        get_action.return_value.side_effect = (
+            lambda context, data_dict: all_groups[
+                data_dict['offset']:data_dict['offset'] + data_dict['limit']])
+
+        groups = plugin._featured_group_org_no_limit(
+            ['g1'], is_organization=False, list_action='group_list', count=3)
+
+        assert [group['name'] for group in groups] == ['g1', 'g0', 'g2']
+        assert get_action.return_value.call_count == 1
+
+    @mock.patch('ckanext.birmingham.plugin.group_summaries')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_names_and_ids_of_the_same_group_are_deduplicated(
+            self, get_action, group_summaries):
+        group_summaries.side_effect = _fake_group_summaries
+        get_action.return_value.return_value = []
+
+        groups = plugin._featured_group_org_no_limit(
+            ['a', 'id_a', 'b'], is_organization=False,
+            list_action='group_list', count=5)
+
+        assert [group['name'] for group in groups] == ['a', 'b']
+
+    @mock.patch('ckanext.birmingham.plugin.group_summaries')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_list_action_that_ignores_limit_and_offset(self, get_action,
+                                                       group_summaries):
+        group_summaries.side_effect = _fake_group_summaries
+        get_action.return_value.return_value = ['a', 'b', 'c']
+
+        groups = plugin._featured_group_org_no_limit(
+            [], is_organization=False, list_action='group_list', count=5)
+
+        assert [group['name'] for group in groups] == ['a', 'b', 'c']
+
+    @mock.patch('ckanext.birmingham.plugin.group_summaries')
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_by_dataset_count_fills_slots_from_one_facet_query(
+            self, get_action, group_summaries):
+        group_summaries.side_effect = _fake_group_summaries
+        package_search = mock.Mock(return_value={'search_facets': {
+            'organization': {'items': [{'name': 'small', 'count': 1},
+                                       {'name': 'big', 'count': 9},
+                                       {'name': 'configured', 'count': 5}]}}})
+        organization_list = mock.Mock(return_value=[])
+        get_action.side_effect = {'package_search': package_search,
+                                  'organization_list': organization_list}.get
+
+        orgs = plugin._featured_group_org_no_limit(
+            ['configured'], is_organization=True,
+            list_action='organization_list', count=3, auto='by_dataset_count')
+
+        assert [org['name'] for org in orgs] == ['configured', 'big', 'small']
+        assert package_search.call_count == 1
+        assert group_summaries.call_count == 1
+        assert not organization_list.called
+
+
+def _add_members_concurrently(organization, admin, users, role):
+    '''Add each of the given users to the organization from its own thread.
+
+    All the threads are started before any of them is allowed to call
+    organization_member_create.
+
+    :returns: a dict mapping user names to True if the user was added and
+              False if not
+    :rtype: dict
+
+    '''
+    import pylons
+    import ckan.lib.cli
+    import ckan.model as model
+
+    start = threading.Event()
+    results = {}
+
+    def add_member(user):
+        pylons.translator._push_object(ckan.lib.cli.MockTranslator())
+        start.wait()
+        try:
+            helpers.call_action('organization_member_create',
+                                context={'user': admin['name']},
+                                id=organization['id'], username=user['name'],
+                                role=role)
+            results[user['name']] = True
+        except toolkit.NotAuthorized:
+            results[user['name']] = False
+        finally:
+            model.Session.remove()
+
+    threads = [threading.Thread(target=add_member, args=(user,))
+               for user in users]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join(30)
+        assert not thread.is_alive(), 'organization_member_create hung'
+    return results
+
+
+class TestEditorCapConcurrency(object):
+
+    '''Tests that the editor cap holds when editors are added concurrently.'''
+
+    def setup(self):
+        helpers.reset_db()
+        plugin._listen_for_editor_changes()
+        self.original_max_editors = config.get('ckan.birmingham.max_editors')
+        config['ckan.birmingham.max_editors'] = '3'
+        settings.reload()
+
+    def teardown(self):
+        import ckan.model as model
+        model.Session.rollback()
+        if self.original_max_editors is None:
+            config.pop('ckan.birmingham.max_editors', None)
+        else:
+            config['ckan.birmingham.max_editors'] = self.original_max_editors
+        settings.reload()
+
+    def test_cap_holds_with_concurrent_editor_creates(self):
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+        users = [factories.User() for i in range(6)]
+
+        results = _add_members_concurrently(organization, admin, users,
+                                            role='editor')
+
+        # The org admin is the first of the 3 editors.
+        assert sorted(results.values()) == [False] * 4 + [True] * 2
+        assert plugin.count_editors_and_sysadmins() == 3
+        assert plugin.editor_count() == 3
+
+    def test_member_creates_do_not_wait_for_the_editor_cap(self):
+        '''Adding normal members shouldn't wait while another transaction
+        has the editor cap locked.
+
+        '''
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+        users = [factories.User() for i in range(3)]
+
+        # Lock the cap in this thread's transaction, until teardown() rolls it
+        # back.
+        plugin.editor_count(for_update=True)
+        results = _add_members_concurrently(organization, admin, users,
+                                            role='member')
+
+        assert all(results.values())
+
+
+class TestMemberCreateMany(object):
+
+    '''Functional tests for the birmingham_member_create_many action.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        _load_plugin('up_to_n_editors')
+        cls.app = _get_test_app()
+
+    def setup(self):
+        helpers.reset_db()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+
+    def test_editors_are_read_from_the_primary_not_the_replica(self):
+        import ckan.model as model
+        sysadmin = factories.Sysadmin()
+        organization = factories.Organization(user=sysadmin)
+        user = factories.User()
+
+        db.setup_read_replica(config['sqlalchemy.url'])
+        try:
+            with mock.patch.object(plugin, '_editor_memberships',
+                                   return_value={}) as editor_memberships:
+                helpers.call_action(
+                    'birmingham_member_create_many',
+                    context={'user': sysadmin['name']},
+                    members=[{'id': organization['id'], 'object': user['id'],
+                              'capacity': 'editor'}])
+        finally:
+            db.setup_read_replica('')
+
+        assert editor_memberships.call_args[0][0] is model.Session
+
+    def test_editors_are_added_up_to_the_cap(self):
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+        users = [factories.User() for i in range(4)]
+        members = [{'id': organization['id'], 'object': user['name'],
+                    'capacity': 'editor'} for user in users]
+        # Normal members are added even after the cap has been reached.
+        members.append({'id': organization['id'], 'object': users[3]['id'],
+                        'capacity': 'member'})
+
+        results = helpers.call_action('birmingham_member_create_many',
+                                      context={'user': admin['name']},
+                                      members=members)
+
+        assert [result['success'] for result in results] == [
+            True, True, False, False, True]
+        assert results[2]['msg'] == "You're only allowed to have 3 editors"
+        member_list = helpers.call_action('member_list',
+                                          id=organization['id'])
+        assert (users[0]['id'], 'user', 'Editor') in member_list
+        assert (users[1]['id'], 'user', 'Editor') in member_list
+        assert (users[2]['id'], 'user', 'Editor') not in member_list
+        assert (users[3]['id'], 'user', 'Member') in member_list
+
+    def test_existing_editors_do_not_count_twice(self):
+        admin = factories.User()
+        organization_1 = factories.Organization(user=admin)
+        organization_2 = factories.Organization(user=admin)
+        editor = factories.User()
+        members = [{'id': organization['id'], 'object': editor['id'],
+                    'capacity': 'editor'}
+                   for organization in (organization_1, organization_2)]
+
+        results = helpers.call_action('birmingham_member_create_many',
+                                      context={'user': admin['name']},
+                                      members=members)
+
+        assert all(result['success'] for result in results)
+        assert plugin.count_editors_and_sysadmins() == 2
+
+    def test_demoted_editors_make_room_for_new_ones(self):
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+        users = [factories.User() for i in range(3)]
+        helpers.call_action(
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=[{'id': organization['id'], 'object': users[0]['id'],
+                      'capacity': 'editor'},
+                     {'id': organization['id'], 'object': users[1]['id'],
+                      'capacity': 'editor'}])
+
+        results = helpers.call_action(
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=[{'id': organization['id'], 'object': users[0]['id'],
+                      'capacity': 'member'},
+                     {'id': organization['id'], 'object': users[2]['id'],
+                      'capacity': 'editor'}])
+
+        assert all(result['success'] for result in results)
+        assert plugin.count_editors_and_sysadmins() == 3
+
+    def test_users_who_are_editors_elsewhere_stay_editors(self):
+        admin = factories.User()
+        organization_1 = factories.Organization(user=admin)
+        organization_2 = factories.Organization(user=admin)
+        users = [factories.User() for i in range(3)]
+        helpers.call_action(
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=[{'id': organization['id'], 'object': users[0]['id'],
+                      'capacity': 'editor'}
+                     for organization in (organization_1, organization_2)] +
+            [{'id': organization_1['id'], 'object': users[2]['id'],
+              'capacity': 'editor'}])
+
+        # users[0] is still an editor of organization_2, so there's no room
+        # for users[1].
+        results = helpers.call_action(
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=[{'id': organization_1['id'], 'object': users[0]['id'],
+                      'capacity': 'member'},
+                     {'id': organization_1['id'], 'object': users[1]['id'],
+                      'capacity': 'editor'}])
+
+        assert [result['success'] for result in results] == [True, False]
+
+    def test_nothing_is_left_in_the_session_when_all_are_refused(self):
+        import ckan.model as model
+        admin = factories.User()
+        other_organization = factories.Organization()
+        user = factories.User()
+
+        with mock.patch.object(model.Session, 'rollback',
+                               wraps=model.Session.rollback) as rollback:
+            results = helpers.call_action(
+                'birmingham_member_create_many',
+                context={'user': admin['name']},
+                members=[{'id': other_organization['id'],
+                          'object': user['id'], 'capacity': 'editor'}])
+
+        assert not results[0]['success']
+        assert rollback.called
+        assert not model.Session.new
+
+    def test_missing_fields_are_reported_as_an_error_dict(self):
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+
+        results = helpers.call_action(
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=[{'id': organization['id'], 'capacity': 'member'}])
+
+        assert results[0]['success'] is False
+        assert 'object' in results[0]['msg']
+
+    def test_members_must_be_dicts(self):
+        admin = factories.User()
+
+        nose.tools.assert_raises(
+            toolkit.ValidationError, helpers.call_action,
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=['not-a-dict'])
+
+    def test_memberships_the_user_cannot_create_are_refused(self):
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+        other_organization = factories.Organization()
+        user = factories.User()
+
+        results = helpers.call_action(
+            'birmingham_member_create_many', context={'user': admin['name']},
+            members=[{'id': other_organization['id'], 'object': user['id'],
+                      'capacity': 'member'},
+                     {'id': organization['id'], 'object': user['id'],
+                      'capacity': 'member'},
+                     {'id': 'no-such-org', 'object': user['id'],
+                      'capacity': 'member'}])
+
+        assert [result['success'] for result in results] == [
+            False, True, False]
+
+
+class TestSettings(object):
+
+    '''Tests for the parsed settings object.'''
+
+    def test_defaults(self):
+        defaults = Settings({})
+
+        assert defaults.max_editors == 3
+        assert defaults.featured_orgs == ()
+        assert defaults.featured_caption == 'This is a featured section'
+
+    def test_values_are_parsed(self):
+        parsed = Settings({'ckan.birmingham.max_editors': '6',
+                           'ckan.featured_orgs': 'org-a  org-b',
+                           'ckanext.birmingham.featured_caption': ''})
+
+        assert parsed.max_editors == 6
+        assert parsed.featured_orgs == ('org-a', 'org-b')
+        assert parsed.featured_caption == ''
+
+    def test_invalid_max_editors(self):
+        nose.tools.assert_raises(
+            ValueError, Settings, {'ckan.birmingham.max_editors': 'six'})
+        nose.tools.assert_raises(
+            ValueError, Settings, {'ckan.birmingham.max_editors': '-1'})
+
+    def test_invalid_featured_auto_mode(self):
+        nose.tools.assert_raises(
+            ValueError, Settings, {'ckan.featured_orgs.auto': 'by_size'})
+
+    def test_invalid_cache_backend(self):
+        nose.tools.assert_raises(
+            ValueError, Settings,
+            {'ckanext.birmingham.cache_backend': 'memcached://localhost'})
+
+    def test_settings_do_not_take_other_attributes(self):
+        nose.tools.assert_raises(AttributeError, setattr, Settings(),
+                                 'max_editor', 3)
+
+
+class TestCachedSnippet(object):
+
+    '''Tests for the birmingham_cached_snippet() helper.'''
+
+    def setup(self):
+        plugin._fragment_cache.configure(maxsize=8, ttl=60)
+
+    def teardown(self):
+        plugin._fragment_cache.clear()
+
+    @mock.patch('ckan.lib.helpers.lang')
+    @mock.patch('ckan.lib.helpers.snippet')
+    def test_snippet_is_rendered_once_per_locale(self, snippet, lang):
+        snippet.return_value = '<p>featured</p>'
+        lang.return_value = 'en'
+
+        for i in range(3):
+            html = plugin.cached_snippet('home/snippets/fragments/promoted.html')
+        lang.return_value = 'de'
+        plugin.cached_snippet('home/snippets/fragments/promoted.html')
+
+        assert html == '<p>featured</p>'
+        assert snippet.call_count == 2
+
+    @mock.patch('ckan.lib.helpers.lang')
+    @mock.patch('ckan.lib.helpers.snippet')
+    def test_cache_is_emptied_when_a_package_changes(self, snippet, lang):
+        snippet.return_value = '<p>featured</p>'
+        lang.return_value = 'en'
+        plugin.cached_snippet('home/snippets/fragments/search.html')
+
+        plugin.BirminghamPlugin().edit(mock.Mock())
+        plugin.cached_snippet('home/snippets/fragments/search.html')
+
+        assert snippet.call_count == 2
+
+    @mock.patch('ckan.lib.helpers.lang')
+    @mock.patch('ckan.lib.helpers.snippet')
+    def test_logged_in_users_get_uncached_renders(self, snippet, lang):
+        snippet.return_value = '<p>featured</p>'
+        lang.return_value = 'en'
+
+        with mock.patch.object(plugin.toolkit, 'c', mock.Mock(user='member')):
+            plugin.cached_snippet('home/snippets/fragments/search.html')
+            plugin.cached_snippet('home/snippets/fragments/search.html')
+        assert snippet.call_count == 2
+
+        # Nor did they fill the cache for anonymous users.
+        plugin.cached_snippet('home/snippets/fragments/search.html')
+        assert snippet.call_count == 3
+
+
+class TestCachedSnippetPrivacy(object):
+
+    '''Functional tests for what the cached homepage fragments show.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        _load_plugin('birmingham')
+        _load_plugin('customizable_featured_image')
+        cls.app = _get_test_app()
+
+    def setup(self):
+        helpers.reset_db()
+        plugin._fragment_cache.clear()
+        plugin._featured_cache.clear()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+        settings.reload()
+
+    def test_members_private_datasets_are_not_shown_to_anonymous_users(self):
+        member = factories.User()
+        organization = factories.Organization(user=member)
+        factories.Dataset(owner_org=organization['id'], private=True,
+                          title='A very private dataset')
+        config['ckan.featured_orgs'] = organization['name']
+        settings.reload()
+
+        self.app.get('/', extra_environ={'REMOTE_USER': str(member['name'])})
+        response = self.app.get('/')
+
+        assert 'A very private dataset' not in response
+
+
+class TestPopularTags(object):
+
+    '''Tests for the birmingham_popular_tags() helper.'''
+
+    def setup(self):
+        plugin._popular_tags_cache.configure(maxsize=8, ttl=60)
+
+    def teardown(self):
+        plugin._popular_tags_cache.clear()
+
+    @mock.patch('ckanext.birmingham.plugin.logic.get_action')
+    def test_tags_come_from_one_cached_facet_query(self, get_action):
+        get_action.return_value.return_value = {'search_facets': {'tags': {
+            'items': [{'name': 'a', 'display_name': 'a', 'count': 1},
+                      {'name': 'b', 'display_name': 'b', 'count': 5},
+                      {'name': 'c', 'display_name': 'c', 'count': 3}]}}}
+
+        for i in range(3):
+            tags = plugin.popular_tags(2)
+
+        assert [tag['name'] for tag in tags] == ['b', 'c']
+        assert get_action.return_value.call_count == 1
+        data_dict = get_action.return_value.call_args[0][1]
+        assert data_dict['rows'] == 0
+        assert data_dict['facet.field'] == ['tags']
+
+
+class TestNotesExtract(object):
+
+    '''Tests for the birmingham_notes_extract() helper.'''
+
+    def setup(self):
+        plugin._notes_cache.configure(maxsize=8, ttl=60)
+
+    def teardown(self):
+        plugin._notes_cache.clear()
+
+    @mock.patch('ckan.lib.helpers.markdown_extract')
+    def test_notes_are_parsed_once_per_modification(self, markdown_extract):
+        markdown_extract.return_value = 'Some notes'
+        package = {'id': 'package_1', 'notes': '*Some* notes',
+                   'metadata_modified': '2014-01-01T00:00:00'}
+
+        for i in range(3):
+            extract = plugin.notes_extract(package, extract_length=180)
+        assert extract == 'Some notes'
+        assert markdown_extract.call_count == 1
+
+        plugin.notes_extract(package, extract_length=80)
+        package['metadata_modified'] = '2014-01-02T00:00:00'
+        plugin.notes_extract(package, extract_length=180)
+        assert markdown_extract.call_count == 3
+
+    @mock.patch('ckan.lib.helpers.markdown_extract')
+    def test_packages_without_notes(self, markdown_extract):
+        assert plugin.notes_extract({'id': 'package_1', 'notes': None}) == ''
+        assert not markdown_extract.called
+
+
+class TestRefresher(object):
+
+    '''Tests for the background cache Refresher.'''
+
+    @mock.patch('ckanext.birmingham.cache.time.time')
+    def test_stale_values_are_served_while_being_revalidated(self, time_):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.refresher = mock.Mock()
+        ttl_cache.refresher.is_running.return_value = True
+        time_.return_value = 1000
+        ttl_cache.set('key', 'stale')
+
+        time_.return_value = 1100
+        assert ttl_cache.get('key') == 'stale'
+        # Never more than another ttl out of date.
+        time_.return_value = 1120
+        assert ttl_cache.get('key') is None
+
+    @mock.patch('ckanext.birmingham.cache.time.time')
+    def test_stale_values_are_not_served_without_a_running_thread(
+            self, time_):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.refresher = mock.Mock()
+        ttl_cache.refresher.is_running.return_value = False
+        time_.return_value = 1000
+        ttl_cache.set('key', 'stale')
+
+        time_.return_value = 1070
+        assert ttl_cache.get('key') is None
+
+    def test_thread_is_started_again_after_a_fork(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        refresher = cache.Refresher([ttl_cache])
+        refresher.start(interval=60)
+        try:
+            thread = refresher._thread
+            with mock.patch('ckanext.birmingham.cache.os.getpid',
+                            return_value=os.getpid() + 1):
+                assert refresher.is_running()
+                assert refresher._thread is not thread
+        finally:
+            refresher.stop()
+            thread.join(10)
+
+    def test_refresh_recomputes_entries_that_are_about_to_expire(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        loader = mock.Mock(return_value='fresh')
+        ttl_cache.set('key', 'old', loader)
+        refresher = cache.Refresher([ttl_cache])
+        refresher.interval = 60
+
+        refresher.refresh()
+
+        assert ttl_cache.get('key') == 'fresh'
+
+    def test_refresh_does_not_put_back_values_after_a_clear(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.set('key', 'old', loader=ttl_cache.clear)
+        refresher = cache.Refresher([ttl_cache])
+        refresher.interval = 60
+
+        refresher.refresh()
+
+        assert ttl_cache.get('key') is None
+
+    def test_loader_errors_keep_the_stale_value(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.set('key', 'old',
+                      loader=mock.Mock(side_effect=Exception('DB is down')))
+        cleanup = mock.Mock()
+        refresher = cache.Refresher([ttl_cache], cleanup=cleanup)
+        refresher.interval = 60
+
+        refresher.refresh()
+
+        assert ttl_cache.get('key') == 'old'
+        assert cleanup.called
+
+    def test_start_warms_and_stop_shuts_down(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        warmed = threading.Event()
+        refresher = cache.Refresher([ttl_cache], warm=[warmed.set])
+
+        refresher.start(interval=60)
+        try:
+            assert warmed.wait(10)
+            assert ttl_cache.stale_while_revalidate
+        finally:
+            refresher.stop()
+
+        assert refresher._thread is None
+        assert not ttl_cache.stale_while_revalidate
+
+
+class TestConditionalGet(object):
+
+    '''Functional tests for the ETag/304 middleware.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        _load_plugin('birmingham')
+        cls.app = _get_test_app()
+
+    def setup(self):
+        helpers.reset_db()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+
+    def test_homepage_has_an_etag_and_last_modified(self):
+        response = self.app.get('/')
+
+        assert response.headers['ETag'].startswith('W/"')
+        assert 'Last-Modified' in response.headers
+
+    def test_matching_if_none_match_gets_a_304(self):
+        etag = self.app.get('/dataset').headers['ETag']
+
+        response = self.app.get('/dataset', headers={'If-None-Match': etag},
+                                status=304)
+
+        assert response.body == b''
+        assert response.headers['ETag'] == etag
+
+    def test_if_modified_since_is_not_honoured_after_a_settings_change(self):
+        last_modified = self.app.get('/').headers['Last-Modified']
+        self.app.get('/', headers={'If-Modified-Since': last_modified},
+                     status=304)
+
+        config['ckanext.birmingham.featured_cache_ttl'] = '123'
+        settings.reload()
+        try:
+            response = self.app.get(
+                '/', headers={'If-Modified-Since': last_modified})
+        finally:
+            del config['ckanext.birmingham.featured_cache_ttl']
+            settings.reload()
+
+        assert response.status_int == 200
+        assert response.headers['Last-Modified'] != last_modified
+
+    def test_etag_changes_when_a_package_changes(self):
+        etag = self.app.get('/').headers['ETag']
+
+        factories.Dataset()
+
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        assert response.status_int == 200
+        assert response.headers['ETag'] != etag
+
+    def test_revision_is_bumped_when_the_change_is_committed(self):
+        import ckan.model as model
+        revision = db.get_or_create_counter(
+            middleware.CONTENT_REVISION_COUNTER)[0]
+
+        plugin.BirminghamPlugin().edit(mock.Mock())
+        assert db.get_or_create_counter(
+            middleware.CONTENT_REVISION_COUNTER)[0] == revision
+        model.Session.commit()
+
+        assert db.get_or_create_counter(
+            middleware.CONTENT_REVISION_COUNTER)[0] == revision + 1
+
+    def test_revision_is_not_bumped_when_the_change_is_rolled_back(self):
+        import ckan.model as model
+        revision = db.get_or_create_counter(
+            middleware.CONTENT_REVISION_COUNTER)[0]
+
+        plugin.BirminghamPlugin().edit(mock.Mock())
+        model.Session.rollback()
+        model.Session.commit()
+
+        assert db.get_or_create_counter(
+            middleware.CONTENT_REVISION_COUNTER)[0] == revision
+
+    def test_etag_depends_on_the_query_string(self):
+        etag = self.app.get('/dataset').headers['ETag']
+
+        response = self.app.get('/dataset?page=2')
+
+        assert response.headers['ETag'] != etag
+
+    def test_etag_depends_on_the_locale(self):
+        etag = self.app.get('/dataset').headers['ETag']
+
+        response = self.app.get('/de/dataset')
+
+        assert response.headers['ETag'] != etag
+
+    def test_etag_changes_when_the_site_config_changes(self):
+        import ckan.model as model
+        etag = self.app.get('/').headers['ETag']
+
+        model.set_system_info('ckan.site_title', 'Another title')
+        model.Session.commit()
+
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        assert response.status_int == 200
+
+    def test_etag_changes_when_the_static_files_change(self):
+        etag = self.app.get('/').headers['ETag']
+
+        with mock.patch.object(assets, 'manifest_digest',
+                               return_value='0123456789ab'):
+            response = self.app.get('/', headers={'If-None-Match': etag})
+
+        assert response.status_int == 200
+
+    def test_logged_in_users_do_not_get_etags(self):
+        response = self.app.get('/', headers={'Cookie': 'auth_tkt=abc'})
+
+        assert 'ETag' not in response.headers
+
+    def test_other_pages_do_not_get_etags(self):
+        response = self.app.get('/about')
+
+        assert 'ETag' not in response.headers
+
+
+class TestFeaturedImageDerivatives(object):
+
+    '''Tests for the featured image's resized variants.'''
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _image(self, size):
+        if images.Image is None:
+            raise nose.SkipTest('PIL is not installed')
+        path = os.path.join(self.directory, 'featured.jpeg')
+        images.Image.new('RGB', size, 'red').save(path, 'JPEG')
+        return path
+
+    def test_1x_and_2x_variants_are_written(self):
+        source = self._image((1000, 600))
+
+        sources = images.build_derivatives(
+            source, directory=os.path.join(self.directory, 'featured'))
+
+        jpeg = [s for s in sources if s['type'] == 'image/jpeg'][0]
+        urls = [candidate.split()[0]
+                for candidate in jpeg['srcset'].split(', ')]
+        assert [candidate.split()[1]
+                for candidate in jpeg['srcset'].split(', ')] == ['1x', '2x']
+        for url, size in zip(urls, [(420, 220), (840, 440)]):
+            path = os.path.join(self.directory, 'featured',
+                                os.path.basename(url))
+            assert images.Image.open(path).size == size
+
+    def test_small_images_are_not_scaled_up(self):
+        source = self._image((500, 300))
+
+        sources = images.build_derivatives(
+            source, directory=os.path.join(self.directory, 'featured'))
+
+        assert all(' 2x' not in s['srcset'] for s in sources)
+
+    def test_variants_get_fingerprinted_urls(self):
+        source = self._image((1000, 600))
+
+        sources = images.build_derivatives(source)
+        candidates = [candidate.split()[0] for s in sources
+                      for candidate in s['srcset'].split(', ')]
+        found = [assets.lookup(url) for url in candidates]
+        try:
+            assert candidates
+            assert all(entry is not None for entry in found)
+        finally:
+            for entry in found:
+                if entry is not None:
+                    os.remove(entry[1])
+            assets.load_manifest()
+
+    def test_images_smaller_than_the_box_get_no_variants(self):
+        source = self._image((300, 200))
+
+        sources = images.build_derivatives(
+            source, directory=os.path.join(self.directory, 'featured'))
+
+        assert sources == []
+        assert not os.path.exists(os.path.join(self.directory, 'featured'))
+
+    def test_find_public_file(self):
+        path = os.path.join(self.directory, 'featured.jpeg')
+        open(path, 'wb').close()
+        config_ = {'extra_public_paths': self.directory}
+
+        assert images.find_public_file('/featured.jpeg', config_) == path
+        assert images.find_public_file('/missing.jpeg', config_) is None
+        assert images.find_public_file('http://placehold.it/420x220',
+                                       config_) is None
+
+    def test_remote_featured_image_has_no_sources(self):
+        settings.featured_image = 'http://placehold.it/420x220'
+        try:
+            assert featured.build_featured_image_derivatives({}) == []
+            assert featured.featured_image_sources() == []
+        finally:
+            settings.reload()
+
+
+class TestAssets(object):
+
+    '''Tests for the extension's fingerprinted static file URLs.'''
+
+    def setup(self):
+        self.app = webtest.TestApp(middleware.AssetMiddleware(
+            mock.Mock(side_effect=Exception('CKAN should not be called'))))
+
+    def test_manifest_has_public_and_fanstatic_files(self):
+        manifest = assets.load_manifest()
+
+        assert '/favicon.ico' in manifest
+        assert 'ckanext-birmingham/styles/birmingham.css' in manifest
+
+    def test_url_changes_with_the_content(self):
+        url = assets.asset_url('/favicon.ico')
+
+        assert url.startswith(assets.PREFIX + '/')
+        assert url.endswith('/favicon.ico')
+        assert url != '/favicon.ico'
+
+    def test_unknown_names_are_returned_unchanged(self):
+        assert (assets.asset_url('http://placehold.it/420x220') ==
+                'http://placehold.it/420x220')
+
+    def test_current_url_is_served_immutable(self):
+        response = self.app.get(assets.asset_url('/favicon.ico'))
+
+        assert 'immutable' in response.headers['Cache-Control']
+        with open(os.path.join(assets.PUBLIC_DIRECTORY, 'favicon.ico'),
+                  'rb') as file_:
+            assert response.body == file_.read()
+
+    def test_old_url_is_served_without_long_lived_headers(self):
+        response = self.app.get(
+            assets.PREFIX + '/0123456789ab/ckanext-birmingham/styles/'
+            'birmingham.css')
+
+        assert response.headers['Cache-Control'] == 'no-cache'
+        assert response.content_type == 'text/css'
+
+    def test_unknown_file_is_404(self):
+        self.app.get(assets.PREFIX + '/0123456789ab/../setup.py', status=404)
+
+
+class TestPrecompressedAssets(object):
+
+    '''Tests for the static files' precompressed siblings.'''
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'birmingham.css')
+        with open(self.path, 'wb') as file_:
+            file_.write(b'.featured { color: red; }\n' * 100)
+        name = 'ckanext-birmingham/styles/birmingham.css'
+        self.manifest = mock.patch.object(
+            assets, '_manifest', {name: (self.path, '0123456789ab')})
+        self.manifest.start()
+        self.url = assets.asset_url(name)
+        self.app = webtest.TestApp(middleware.AssetMiddleware(
+            mock.Mock(side_effect=Exception('CKAN should not be called'))))
+
+    def teardown(self):
+        self.manifest.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_gzip_sibling_is_written(self):
+        written = assets.compress_static_files()
+
+        assert self.path + '.gz' in written
+        with gzip.open(self.path + '.gz', 'rb') as file_:
+            assert file_.read() == open(self.path, 'rb').read()
+
+    def test_gzip_sibling_is_served_when_accepted(self):
+        assets.compress_static_files()
+
+        response = self.app.get(self.url,
+                                headers={'Accept-Encoding': 'gzip, deflate'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert response.body == open(self.path + '.gz', 'rb').read()
+
+    def test_file_is_served_when_gzip_is_not_accepted(self):
+        assets.compress_static_files()
+
+        response = self.app.get(self.url,
+                                headers={'Accept-Encoding': 'gzip;q=0'})
+
+        assert 'Content-Encoding' not in response.headers
+        assert response.body == open(self.path, 'rb').read()
+
+    def test_stale_siblings_are_not_served(self):
+        assets.compress_static_files()
+        mtime = os.path.getmtime(self.path + '.gz')
+        os.utime(self.path, (mtime + 10, mtime + 10))
+
+        assert assets.precompressed(self.path, 'gzip') is None
+
+
+class TestPageAssets(object):
+
+    '''Functional tests for the static files that the pages link to.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        # customizable_featured_image adds the templates directory, with the
+        # base.html that links the stylesheet.
+        _load_plugin('birmingham')
+        _load_plugin('customizable_featured_image')
+        cls.app = _get_test_app()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+
+    def test_stylesheet_is_served_precompressed(self):
+        written = assets.compress_static_files()
+        try:
+            page = self.app.get('/')
+            url = re.search(br'href="(/birmingham-assets/[0-9a-f]+/'
+                            br'ckanext-birmingham/styles/birmingham\.css)"',
+                            page.body).group(1).decode('ascii')
+            response = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+        finally:
+            for path in written:
+                os.remove(path)
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in response.headers['Cache-Control']
+
+
+# The most SQL statements that each of these may run, however much data the
+# site has.
+HOMEPAGE_QUERY_BUDGET = 30
+SEARCH_PAGE_QUERY_BUDGET = 30
+MEMBER_CREATE_AUTH_QUERY_BUDGET = 15
+FEATURED_QUERY_BUDGET = 12
+
+
+class TestQueryCounts(object):
+
+    '''Tests that pages and auth checks run a fixed number of SQL statements.
+
+    Each test measures the same thing with a little and with more data, and
+    fails if the number of statements grows with the data (an N+1 query).
+
+    '''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        for plugin_name in ('birmingham', 'up_to_n_editors',
+                            'customizable_featured_image'):
+            _load_plugin(plugin_name)
+        cls.app = _get_test_app()
+
+    def setup(self):
+        helpers.reset_db()
+        plugin._listen_for_editor_changes()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+        settings.reload()
+
+    def _count_get(self, url):
+        # Empty the caches so every request builds everything it shows.
+        for ttl_cache in (plugin._featured_cache, plugin._fragment_cache,
+                          plugin._popular_tags_cache, plugin._notes_cache):
+            ttl_cache.clear()
+        with count_queries() as queries:
+            self.app.get(url)
+        return queries.count
+
+    def test_homepage(self):
+        user = factories.User()
+        for i in range(2):
+            organization = factories.Organization(user=user)
+            group = factories.Group(user=user)
+            factories.Dataset(owner_org=organization['id'],
+                              groups=[{'name': group['name']}])
+        self.app.get('/')
+        few = self._count_get('/')
+
+        for i in range(8):
+            organization = factories.Organization(user=user)
+            group = factories.Group(user=user)
+            factories.Dataset(owner_org=organization['id'],
+                              groups=[{'name': group['name']}])
+        many = self._count_get('/')
+
+        assert many == few, (few, many)
+        assert many <= HOMEPAGE_QUERY_BUDGET, many
+
+    def test_featured_organizations_and_groups(self):
+        user = factories.User()
+
+        def create(n):
+            for i in range(n):
+                factories.Organization(user=user)
+                factories.Group(user=user)
+
+        def count(missing):
+            # Configured names that don't resolve to any group or org.
+            settings.featured_orgs = tuple(
+                'missing-org-{0}'.format(i) for i in range(missing))
+            settings.featured_groups = tuple(
+                'missing-group-{0}'.format(i) for i in range(missing))
+            plugin._featured_cache.clear()
+            with count_queries() as queries:
+                orgs = plugin.get_featured_org_no_limit(count=3)
+                groups = plugin.get_featured_groups_no_limit(count=3)
+            assert len(orgs) == len(groups) == 3
+            return queries.count
+
+        try:
+            create(4)
+            count(2)
+            few = count(2)
+
+            create(8)
+            many = count(8)
+        finally:
+            settings.reload()
+
+        assert many == few, (few, many)
+        assert many <= FEATURED_QUERY_BUDGET, many
+
+    def test_search_page_with_20_datasets(self):
+        resources = [{'url': 'http://example.com/data.csv', 'format': 'CSV'}]
+        for i in range(5):
+            factories.Dataset(resources=resources)
+        self.app.get('/dataset')
+        few = self._count_get('/dataset')
+
+        for i in range(15):
+            factories.Dataset(resources=resources)
+        many = self._count_get('/dataset')
+
+        assert many == few, (few, many)
+        assert many <= SEARCH_PAGE_QUERY_BUDGET, many
+
+    def test_member_create_auth_check(self):
+        config['ckan.birmingham.max_editors'] = '100'
+        settings.reload()
+        admin = factories.User()
+        organization = factories.Organization(user=admin)
+        new_user = factories.User()
+        data_dict = {'id': organization['id'], 'object': new_user['id'],
+                     'object_type': 'user', 'capacity': 'editor'}
+
+        def check():
+            with count_queries() as queries:
+                toolkit.check_access('member_create', {'user': admin['name']},
+                                     dict(data_dict))
+            return queries.count
+
+        check()
+        few = check()
+
+        for i in range(10):
+            helpers.call_action(
+                'member_create', context={'user': admin['name']},
+                id=organization['id'], object=factories.User()['id'],
+                object_type='user', capacity='editor')
+        many = check()
+
+        assert many == few, (few, many)
+        assert many <= MEMBER_CREATE_AUTH_QUERY_BUDGET, many
+
+
+class TestMetrics(object):
+
+    '''Tests for the helper and auth function metrics.'''
+
+    def setup(self):
+        metrics.reset()
+        settings.metrics = True
+
+    def teardown(self):
+        metrics.reset()
+        settings.reload()
+
+    def test_calls_are_recorded_in_a_histogram(self):
+        helper = metrics.instrument('helper', 'get_package_info',
+                                    lambda pkg_id: pkg_id)
+
+        for i in range(3):
+            assert helper('package_1') == 'package_1'
+
+        text = metrics.prometheus_text()
+        labels = 'kind="helper",name="get_package_info"'
+        assert ('birmingham_call_duration_seconds_count{{{0}}} 3'.format(
+            labels) in text)
+        assert ('birmingham_call_duration_seconds_bucket{{{0},le="+Inf"}} 3'
+                .format(labels) in text)
+        assert ('birmingham_call_queries_total{{{0}}} 0'.format(labels)
+                in text)
+
+    def test_nothing_is_recorded_when_metrics_are_off(self):
+        settings.metrics = False
+        helper = metrics.instrument('helper', 'get_package_info',
+                                    lambda pkg_id: pkg_id)
+
+        helper('package_1')
+
+        assert 'get_package_info' not in metrics.prometheus_text()
+
+    def test_queries_on_the_read_replica_are_counted(self):
+        db.setup_read_replica(config['sqlalchemy.url'])
+        try:
+            helper = metrics.instrument('helper', 'sysadmins',
+                                        plugin.sysadmins)
+            helper()
+        finally:
+            db.setup_read_replica('')
+
+        text = metrics.prometheus_text()
+        assert ('birmingham_call_queries_total{kind="helper",'
+                'name="sysadmins"} 0' not in text)
+        assert 'name="sysadmins"' in text
+
+    def test_memo_stats_helper_is_instrumented(self):
+        helper = plugin.BirminghamPlugin().get_helpers()[
+            'birmingham_memo_stats']
+
+        helper()
+
+        assert 'name="birmingham_memo_stats"' in metrics.prometheus_text()
+
+    def test_cache_hits_and_misses(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60, name='featured')
+        for i in range(3):
+            cache.cached(ttl_cache, 'key', lambda: 'value')
+
+        text = metrics.prometheus_text([('featured', ttl_cache)])
+
+        assert 'birmingham_cache_hits_total{cache="featured"} 2' in text
+        assert 'birmingham_cache_misses_total{cache="featured"} 1' in text
+
+
+class TestMetricsEndpoint(object):
+
+    '''Functional tests for the /birmingham/metrics endpoint.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_config = config.copy()
+        _load_plugin('birmingham')
+        config['ckanext.birmingham.metrics'] = 'true'
+        cls.app = _get_test_app()
+
+    def setup(self):
+        metrics.reset()
+
+    @classmethod
+    def teardown_class(cls):
+        config.clear()
+        config.update(cls.original_config)
+        settings.reload()
+
+    def test_metrics_are_served_as_prometheus_text(self):
+        response = self.app.get('/birmingham/metrics')
+
+        assert response.content_type == 'text/plain'
+        assert '# TYPE birmingham_call_duration_seconds histogram' in response
+        assert 'birmingham_cache_hits_total{cache="featured"}' in response
+
+    def test_endpoint_is_404_when_metrics_are_off(self):
+        settings.metrics = False
+        try:
+            self.app.get('/birmingham/metrics', status=404)
+        finally:
+            settings.metrics = True
@@ -29,5 +29,8 @@ setup(
         customizable_featured_image=ckanext.birmingham.customizable_featured_image:CustomizableFeaturedImagePlugin
         birmingham=ckanext.birmingham.plugin:BirminghamPlugin
 
+        [paste.paster_command]
+        birmingham=ckanext.birmingham.commands:BirminghamCommand
+
     ''',
 )